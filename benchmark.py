@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+import random, statistics, sys, time
+from structures.db import Database
+
+# Benchmark how long a user_stats lookup takes with the original schema (TEXT columns, no indexes) and with the
+# typed and indexed schema from update 2026101802. Both tables are created as scratch copies and dropped afterwards.
+# Usage: python3 benchmark.py [rows] [lookups]
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+LOOKUPS = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+BATCH_SIZE = 10000
+STATS = ['words_written', 'sprints_started', 'sprints_completed', 'sprints_won', 'sprints_words_written',
+         'challenges_completed', 'daily_goals_completed', 'weekly_goals_completed', 'monthly_goals_completed', 'total_xp']
+
+TABLES = {
+    'benchmark_before': 'CREATE TABLE benchmark_before (id INTEGER PRIMARY KEY auto_increment, user TEXT NOT NULL, '
+                        'name TEXT NOT NULL, value INTEGER DEFAULT 0) CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci',
+    'benchmark_after': 'CREATE TABLE benchmark_after (id INTEGER PRIMARY KEY auto_increment, user BIGINT UNSIGNED NOT NULL, '
+                       'name VARCHAR(255) NOT NULL, value INTEGER DEFAULT 0, UNIQUE INDEX user_name (user, name)) '
+                       'CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci',
+}
+
+db = Database.instance()
+
+# Every user gets a row for each stat, with random snowflake-sized IDs
+users = [random.getrandbits(63) for i in range(ROWS // len(STATS))]
+rows = [{'user': user, 'name': name, 'value': random.randint(0, 100000)} for user in users for name in STATS]
+
+for table, sql in TABLES.items():
+
+    db.execute('DROP TABLE IF EXISTS ' + table, [])
+    db.execute(sql, [])
+
+    for i in range(0, len(rows), BATCH_SIZE):
+        db.insert_many(table, rows[i:i + BATCH_SIZE])
+
+print(f'Inserted {len(rows)} rows into each table, running {LOOKUPS} lookups')
+
+try:
+
+    for table in TABLES.keys():
+
+        timings = []
+        for i in range(LOOKUPS):
+            where = {'user': random.choice(users), 'name': random.choice(STATS)}
+            start = time.perf_counter()
+            db.get(table, where)
+            timings.append((time.perf_counter() - start) * 1000)
+
+        timings.sort()
+        print(f'{table}: mean {statistics.mean(timings):.3f}ms, p50 {timings[len(timings) // 2]:.3f}ms, '
+              f'p99 {timings[int(len(timings) * 0.99)]:.3f}ms')
+
+finally:
+    for table in TABLES.keys():
+        db.execute('DROP TABLE IF EXISTS ' + table, [])
@@ -1,25 +1,54 @@
-import os, datetime, time, lib, traceback, discord
+import os, datetime, hashlib, importlib, time, lib, traceback, discord
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from discord.ext import tasks
 from discord.ext import commands
 from discord.ext.commands import AutoShardedBot
+from structures.asset import AssetStore
 from structures.db import *
 from structures.guild import Guild
+from structures.loopmonitor import LoopMonitor
+from structures.metrics import Metrics
+from structures.names import NameCache
+from structures.querylog import QueryLog
+from structures.scheduler import Scheduler
+from structures.stats import StatBuffer
 from structures.task import Task
+from structures.unitofwork import UnitOfWork
 from structures.user import User
 
 class WriterBot(AutoShardedBot):
 
     COMMAND_GROUPS = ['util', 'fun', 'writing']
-    SCHEDULED_TASK_LOOP = 30.0 # Seconds
     CLEANUP_TASK_LOOP = 1.0 # Hours
-
-    def __init__(self, *args, **kwargs):
+    STAT_FLUSH_LOOP = 30.0 # Seconds
+    CLUSTER_STAT_FLUSH_LOOP = 5.0 # Seconds between writing the buffered stats in cluster mode, so the other workers see them sooner
+    COG_LOAD_THREADS = 8
+    CLUSTER_REPORT_LOOP = 60.0 # Seconds
+    RECURRING_TASKS = [
+        {'object': 'goal', 'type': 'reset', 'runeveryseconds': 900},
+        {'object': 'event', 'type': 'repair', 'runeveryseconds': 3600},
+    ]
+
+    def __init__(self, *args, cluster=None, **kwargs):
         super().__init__(help_command=commands.DefaultHelpCommand(dm_help=True), *args, **kwargs)
-        self.config = lib.get('./settings.json')
+        self.cluster = cluster
+        self.config = lib.get_config()
         self.start_time = time.time()
+        self.started = time.perf_counter()
+        self.stats_flushed = time.time()
+        self.startup_times = []
+        self.fast_startup = bool(getattr(self.config, 'fast_startup', False))
         self.app_info = None
+        self.prefixes = {}
+        self.before_invoke(self.before_command)
+        self.after_invoke(self.after_command)
         self.setup()
 
+        # Let the cluster supervisor know the setup is done, so it can start the next worker.
+        if self.cluster is not None:
+            self.cluster.started()
+
     async def on_message(self, message):
         """
         Run any checks we need to, before processing the messages.
@@ -32,6 +61,30 @@ class WriterBot(AutoShardedBot):
 
         await self.process_commands(message)
 
+    async def before_command(self, context):
+        """
+        Start a unit of work for each command, so that the users, projects and events it loads are shared,
+        and label the queries it runs with the command name in the query log
+        :param context:
+        :return:
+        """
+        context.started = time.perf_counter()
+        QueryLog.instance().set_caller(str(context.command.cog_name) + ':' + context.command.qualified_name)
+        UnitOfWork.begin()
+
+    async def after_command(self, context):
+        """
+        Once the command has finished, write any changes it left in the unit of work and record it in the metrics
+        :param context:
+        :return:
+        """
+        try:
+            UnitOfWork.end()
+        finally:
+            QueryLog.instance().set_caller(None)
+            Metrics.instance().command_finished(context.command.cog_name, context.command.qualified_name,
+                                                time.perf_counter() - context.started, context.command_failed)
+
     async def on_ready(self):
         """
         Method run once the bot has logged in as is ready to be used.
@@ -39,6 +92,12 @@ class WriterBot(AutoShardedBot):
         """
         lib.debug('Logged on as: ' + str(self.user))
 
+        # The first time we are ready, print how long each part of the startup took.
+        if self.started is not None:
+            self.startup_times.append(('connect', time.perf_counter() - self.started - sum(seconds for phase, seconds in self.startup_times)))
+            self.print_startup_report()
+            self.started = None
+
         # Show the help command on the status
         await self.change_presence(activity=discord.Game(self.config.prefix + 'help'))
 
@@ -46,8 +105,96 @@ class WriterBot(AutoShardedBot):
         self.app_info = await self.application_info()
 
         # Start running the scheduled tasks.
-        self.scheduled_tasks.start()
+        Scheduler.instance().start(self)
         self.cleanup_tasks.start()
+        self.flush_stats.start()
+
+        if self.cluster is not None:
+            self.report_cluster_stats.start()
+
+        # Bring the guild membership table up to date in the background.
+        self.loop.create_task(self.sync_members())
+
+    async def close(self):
+        """
+        Stop the scheduler, write any buffered stats and close the database connection pool before logging out
+        :return:
+        """
+        Scheduler.instance().stop()
+        Metrics.instance().stop()
+        LoopMonitor.instance().stop()
+        try:
+            StatBuffer.instance().flush()
+        finally:
+            await AsyncDatabase.instance().close()
+            await super().close()
+
+    async def on_member_join(self, member):
+        """
+        Keep the cached member set, name and the membership table of the guild up to date
+        :param member:
+        :return:
+        """
+        NameCache.instance().set(member.guild.id, member.id, member.display_name)
+        await Guild.add_member(member.guild.id, member.id)
+
+    async def on_member_remove(self, member):
+        """
+        Keep the cached member set, name and the membership table of the guild up to date
+        :param member:
+        :return:
+        """
+        NameCache.instance().set(member.guild.id, member.id, None)
+        await Guild.remove_member(member.guild.id, member.id)
+
+    async def on_member_update(self, before, after):
+        """
+        Keep the cached name of a member up to date if they change their nickname
+        :param before:
+        :param after:
+        :return:
+        """
+        if before.display_name != after.display_name:
+            NameCache.instance().set(after.guild.id, after.id, after.display_name)
+
+    async def on_user_update(self, before, after):
+        """
+        Drop the cached names of a user if they change their username, as it is the display name wherever they have no nickname
+        :param before:
+        :param after:
+        :return:
+        """
+        if before.name != after.name:
+            NameCache.instance().forget_user(after.id)
+
+    async def on_guild_join(self, guild):
+        """
+        Add the members of a guild the bot has joined to the membership table
+        :param guild:
+        :return:
+        """
+        await AsyncDatabase.instance().call(Guild.sync_members, guild.id, set(member.id for member in guild.members), guild.chunked)
+
+    async def on_guild_remove(self, guild):
+        """
+        Forget the cached member set, names and the membership rows of a guild the bot has left
+        :param guild:
+        :return:
+        """
+        NameCache.instance().forget_guild(guild.id)
+        await Guild.forget_members(guild.id)
+
+    async def sync_members(self):
+        """
+        Sync the membership table with the member lists of all the guilds, one guild at a time, to pick up any joins and
+        leaves which happened while the bot was offline
+        :return:
+        """
+        for guild in list(self.guilds):
+            try:
+                await AsyncDatabase.instance().call(Guild.sync_members, guild.id, set(member.id for member in guild.members), guild.chunked)
+            except Exception as e:
+                lib.error('Exception syncing members of guild ' + str(guild.id) + ': ' + str(e))
 
     async def on_command_error(self, context, error):
         """
@@ -82,23 +229,42 @@ class WriterBot(AutoShardedBot):
         Load all the commands from the cogs/ directory.
         :return: void
         """
-        # Find all the command groups in the cogs/ directory
-        for dir in self.COMMAND_GROUPS:
-
-            # Then all the files inside the command group directory
-            for file in os.listdir(f'cogs/{dir}'):
-
-                # If it ends with .py then try to load it.
-                if file.endswith(".py"):
-
-                    cog = file[:-3]
-
-                    try:
-                        self.load_extension(f"cogs.{dir}.{cog}")
-                        print(f'[EXT][{dir}.{cog}] loaded')
-                    except Exception as e:
-                        print(f'[EXT][{dir}.{cog}] failed to load')
-                        print(e)
+        with self.phase('cogs'):
+
+            # Find all the command groups in the cogs/ directory, and then all the files inside each one
+            cogs = []
+            for dir in self.COMMAND_GROUPS:
+                cogs += [(dir, file[:-3]) for file in os.listdir(f'cogs/{dir}') if file.endswith(".py")]
+
+            # In fast startup, import the cog modules on several threads first. Adding them to the bot still has to
+            # happen one at a time, but it then uses the modules which have already been imported.
+            if self.fast_startup:
+                with ThreadPoolExecutor(max_workers=self.COG_LOAD_THREADS) as executor:
+                    errors = dict(zip(cogs, executor.map(self.import_cog, cogs)))
+            else:
+                errors = {}
+
+            for dir, cog in cogs:
+
+                try:
+                    if errors.get((dir, cog)) is not None:
+                        raise errors[(dir, cog)]
+                    self.load_extension(f"cogs.{dir}.{cog}")
+                    print(f'[EXT][{dir}.{cog}] loaded')
+                except Exception as e:
+                    print(f'[EXT][{dir}.{cog}] failed to load')
+                    print(e)
+
+    def import_cog(self, cog):
+        """
+        Import a cog's module without adding it to the bot
+        :param cog: Tuple of the command group and the cog name
+        :return: The exception if it failed, or None
+        """
+        try:
+            importlib.import_module(f"cogs.{cog[0]}.{cog[1]}")
+        except Exception as e:
+            return e
 
     def update(self):
         """
@@ -116,8 +282,8 @@ class WriterBot(AutoShardedBot):
         version = int(version)
         current_version = int(current_version)
 
-        # Find all update files
-        for file in os.listdir(f'data/updates'):
+        # Find all update files, in order
+        for file in sorted(os.listdir(f'data/updates')):
 
             # If it ends with .update then try to use it.
             if file.endswith(".update"):
@@ -139,87 +305,282 @@ class WriterBot(AutoShardedBot):
         # Once it's done, update the version in the database.
         db.update('bot_settings', {'value': version}, {'setting': 'version'})
 
+        # The tables or columns may have changed, so reload the schema the queries are checked against.
+        db.load_schema()
+
     def setup(self):
         """
         Run the bot setup
         :return:
         """
-        # Install the database.
         db = Database.instance()
-        db.install()
-        print('[DB] Database tables installed')
 
-        # Run any database updates.
-        self.update()
+        with self.phase('database'):
+
+            # In fast startup, the install and updates are skipped if they have already been run on the files as they are now.
+            fingerprint = self.get_schema_fingerprint()
+            if self.fast_startup and self.get_stored_fingerprint() == fingerprint:
+                print('[DB] Database schema is up to date')
+            else:
+
+                # Install the database.
+                db.install()
+                print('[DB] Database tables installed')
+
+                # Run any database updates.
+                self.update()
+                db.upsert('bot_settings', {'setting': 'schema_fingerprint', 'value': fingerprint}, ['setting'])
+
+        # Parse the language packs into memory.
+        with self.phase('strings'):
+            lib.load_strings()
+            print('[LANG] Language strings loaded')
+
+        # Load the custom guild prefixes.
+        with self.phase('prefixes'):
+            self.load_prefixes()
+            print('[PREFIX] Guild prefixes loaded')
+
+        # In fast startup, the rest is done in the background while the shards connect. Assets are loaded when they
+        # are first used if they haven't been loaded yet.
+        if self.fast_startup:
+            self.loop.create_task(self.warm_up())
+        else:
+            self.warm_up_sync()
 
-        # Setup the recurring tasks which need running.
-        self.setup_recurring_tasks()
-        print('[TASK] Recurring tasks inserted')
+        # Start measuring the event loop lag and watching for anything blocking it.
+        LoopMonitor.instance().start(self.loop)
+        print('[LOOP] Event loop monitor starting')
 
-        # Restart all tasks which are marked as processing, in case the bot dropped out during the process.
-        db.update('tasks', {'processing': 0})
+        # Start the metrics server, if it is enabled. It starts listening once the event loop is running.
+        if Metrics.instance().is_enabled():
+            self.loop.create_task(Metrics.instance().start(self))
+            print('[METRICS] Metrics server starting')
 
         # Remove the default 'help' command.
         self.remove_command('help')
 
+    def warm_up_sync(self):
+        """
+        Load the assets and set up the tasks
+        :return:
+        """
+        # Load the JSON assets into memory.
+        with self.phase('assets'):
+            AssetStore.instance().load()
+            print('[ASSET] Assets loaded')
+
+        with self.phase('tasks'):
+
+            # Setup the recurring tasks which need running. In a cluster, only the process which runs them does this.
+            if self.owns_guild(None):
+                for record in self.setup_recurring_tasks():
+                    Scheduler.instance().push(record)
+                print('[TASK] Recurring tasks inserted')
+
+            # Release any tasks whose lease has run out, in case the bot dropped out during the process.
+            self.release_expired_tasks()
+
+    async def warm_up(self):
+        """
+        Load the assets and set up the tasks in the background, on the I/O and database threads
+        :return:
+        """
+        start = time.perf_counter()
+        try:
+            await lib.run_io(AssetStore.instance().load)
+
+            # The scheduler may have already loaded the tasks, so let it know about any we have just created.
+            if self.owns_guild(None):
+                for record in await AsyncDatabase.instance().call(self.setup_recurring_tasks):
+                    Scheduler.instance().push(record)
+
+            await AsyncDatabase.instance().call(self.release_expired_tasks)
+            lib.debug('[STARTUP] Assets and tasks loaded in the background in ' + str(round((time.perf_counter() - start) * 1000)) + 'ms')
+        except Exception as e:
+            lib.error('Exception warming up: ' + str(e))
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time a phase of the startup, for the startup report
+        :param name:
+        :return:
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.startup_times.append((name, time.perf_counter() - start))
+
+    def print_startup_report(self):
+        """
+        Print how long each phase of the startup took
+        :return:
+        """
+        print('[STARTUP] ' + ('Fast' if self.fast_startup else 'Full') + ' startup timings:')
+        for phase, seconds in self.startup_times:
+            print('[STARTUP]   ' + phase.ljust(10) + str(round(seconds * 1000)).rjust(8) + 'ms')
+        print('[STARTUP]   ' + 'total'.ljust(10) + str(round(sum(seconds for phase, seconds in self.startup_times) * 1000)).rjust(8) + 'ms')
+
+    def get_schema_fingerprint(self):
+        """
+        Get a hash of the database version and every install and update file, which changes if any of them do
+        :return: str
+        """
+        fingerprint = hashlib.sha1(str(lib.get('./version.json').db_version).encode())
+        for dir in ('data/install', 'data/updates'):
+            for file in sorted(os.listdir(dir)):
+                fingerprint.update(file.encode())
+                with open(os.path.join(dir, file), 'rb') as f:
+                    fingerprint.update(f.read())
+
+        return fingerprint.hexdigest()
+
+    def get_stored_fingerprint(self):
+        """
+        Get the schema fingerprint stored when the install and updates were last run
+        :return: str or None, if there isn't one or the tables aren't there yet
+        """
+        try:
+            record = Database.instance().get('bot_settings', {'setting': 'schema_fingerprint'})
+        except Exception:
+            return None
+
+        return record['value'] if record else None
+
     def setup_recurring_tasks(self):
         """
-        Create the recurring tasks for the first time.
+        Create the recurring tasks, if they don't exist yet.
+        Existing ones are kept with the same IDs, so a scheduler which has already loaded them can still run them. If
+        one got stuck in processing, its lease runs out and it is released.
+        :return: list of the tasks rows
+        """
+        db = Database.instance()
+
+        records = []
+        for task in self.RECURRING_TASKS:
+
+            record = db.get('tasks', {'object': task['object'], 'type': task['type']})
+            if record is None:
+                db.insert('tasks', dict(task, time=0, recurring=1))
+                record = db.get('tasks', {'id': db.last_insert_id()})
+            elif int(record['runeveryseconds']) != task['runeveryseconds']:
+                db.update('tasks', {'runeveryseconds': task['runeveryseconds']}, {'id': record['id']})
+                record['runeveryseconds'] = task['runeveryseconds']
+
+            records.append(record)
+
+        return records
+
+    def load_prefixes(self):
+        """
+        Load the custom prefixes of all the guilds into memory, with the guild id as the key.
         :return:
         """
         db = Database.instance()
 
-        # Delete the recurring tasks in case they got stuck in processing, and then re-create them.
-        db.delete('tasks', {'object': 'goal', 'type': 'reset'})
-        db.insert('tasks', {'object': 'goal', 'time': 0, 'type': 'reset', 'recurring': 1, 'runeveryseconds': 900})
+        settings = db.get_all('guild_settings', {'setting': 'prefix'})
+        self.prefixes = {int(setting['guild']): setting['value'] for setting in settings}
+
+    def set_prefix(self, guild_id, prefix):
+        """
+        Update the cached prefix for a guild, after its setting has been changed.
+        :param guild_id:
+        :param prefix:
+        :return:
+        """
+        self.prefixes[int(guild_id)] = prefix
 
     @staticmethod
     def load_prefix(bot, message):
         """
-        Get the prefix to use for the guild
+        Get the prefix to use for the guild.
+        This runs on every message, so it only looks at the prefixes already loaded into memory.
         :param bot:
         :param message:
         :return:
         """
-        db = Database.instance()
-        prefixes = {}
-        config = lib.get('./settings.json')
-
-        # Get the guild_settings for prefix and add to a dictionary, with the guild id as the key.
-        settings = db.get_all('guild_settings', {'setting': 'prefix'})
-        for setting in settings:
-            prefixes[int(setting['guild'])] = setting['value']
-
-        # If the guild id exists in this dictionary return that, otherwise return the default.
+        # If the guild has a custom prefix return that, otherwise return the default.
         if message.guild is not None:
-            return prefixes.get(message.guild.id, config.prefix)
+            return bot.prefixes.get(message.guild.id, bot.config.prefix)
         else:
-            return config.prefix
+            return bot.config.prefix
 
-    @tasks.loop(seconds=SCHEDULED_TASK_LOOP)
-    async def scheduled_tasks(self):
+    def release_expired_tasks(self):
         """
-        Execute the scheduled tasks.
-        (I believe) this is going to happen for each shard, so if we have 5 shards for example, this loop will be running simultaneously on each of them.
+        Release any tasks which are marked as processing, but whose owner has stopped renewing the lease on them
         :return:
         """
-        lib.debug('['+str(self.shard_id)+'] Checking for scheduled tasks...')
-
-        try:
-            await Task.execute_all(self)
-        except Exception as e:
-            print('Exception: ' + str(e))
+        db = Database.instance()
+        now = int(time.time())
+        return db.execute('UPDATE tasks SET processing = 0, owner = NULL, lease = 0 WHERE processing = 1 AND lease < %s', [now])
 
     @tasks.loop(hours=CLEANUP_TASK_LOOP)
     async def cleanup_tasks(self):
         """
-        Clean up any old tasks which are still in the database and got stuck in processing
+        Clean up any tasks which got stuck in processing, so they can be run again
         :return:
         """
-        db = Database.instance()
-
         lib.debug('['+str(self.shard_id)+'] Running task cleanup...')
+        self.release_expired_tasks()
+
+    @tasks.loop(seconds=CLUSTER_REPORT_LOOP)
+    async def report_cluster_stats(self):
+        """
+        Send this worker's stats to the cluster supervisor
+        :return:
+        """
+        try:
+            await lib.run_io(self.cluster.report, self.get_local_stats())
+        except Exception as e:
+            lib.error('Exception reporting cluster stats: ' + str(e))
 
-        hour_ago = int(time.time()) - (60*60)
-        db.execute('DELETE FROM tasks WHERE processing = 1 AND time < %s', [hour_ago])
+    def get_local_stats(self):
+        """
+        Get the stats for the guilds in this process
+        :return: dict
+        """
+        return {'guilds': len(self.guilds), 'members': sum(len(guild.members) for guild in self.guilds)}
+
+    async def get_stats(self):
+        """
+        Get the guild and member counts, added up across all the workers if we are running as a cluster
+        :return: dict
+        """
+        stats = self.get_local_stats()
+        if self.cluster is not None:
+            totals = await lib.run_io(self.cluster.get_totals, stats)
+            if totals is not None:
+                return totals
+
+        return stats
+
+    def owns_guild(self, guild_id):
+        """
+        Check if a guild is on one of the shards in this process. Tasks which aren't for a guild belong to the process with shard 0.
+        :param guild_id:
+        :return: bool
+        """
+        if self.shard_ids is None or not self.shard_count:
+            return True
+        elif guild_id is None:
+            return 0 in self.shard_ids
+        else:
+            return (int(guild_id) >> 22) % self.shard_count in self.shard_ids
 
+    @tasks.loop(seconds=CLUSTER_STAT_FLUSH_LOOP)
+    async def flush_stats(self):
+        """
+        Write the buffered user stat increments to the database, every STAT_FLUSH_LOOP seconds.
+        In cluster mode the other workers can't see our buffer when they load a user's stats, so it is written every time.
+        :return:
+        """
+        if self.cluster is None and time.time() - self.stats_flushed < self.STAT_FLUSH_LOOP:
+            return
+
+        self.stats_flushed = time.time()
+        try:
+            StatBuffer.instance().flush()
+        except Exception as e:
+            print('Exception: ' + str(e))
@@ -25,7 +25,7 @@ class XP(commands.Cog):
         if who == 'top':
 
             guild = Guild(context.guild)
-            users = guild.get_top_xp()
+            users = await guild.get_top_xp()
             output = ':trophy: **' + lib.get_string('xp:leaderboard', guild_id) + '** :trophy: \n\n'
             for key in range(len(users)):
                 user = users[key]
@@ -1,12 +1,12 @@
 import os, json, lib, discord, datetime, time
 from discord.ext import commands
-from structures.db import Database
+from structures.db import AsyncDatabase
 
 class About(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        self.__db = Database.instance()
+        self.__db = AsyncDatabase.instance()
 
     @commands.command(aliases=['info'])
     @commands.guild_only()
@@ -21,7 +21,8 @@ class About(commands.Cog):
         uptime = int(round(now - self.bot.start_time))
         guild_id = context.guild.id
         config = self.bot.config
-        sprints = self.__db.get('sprints', {'completed': 0}, ['COUNT(id) as cnt'])['cnt']
+        sprints = (await self.__db.get('sprints', {'completed': 0}, ['COUNT(id) as cnt']))['cnt']
+        totals = await self.bot.get_stats()
 
         # Begin the embedded message
         embed = discord.Embed(title=lib.get_string('info:bot', guild_id), color=3447003)
@@ -31,18 +32,16 @@ class About(commands.Cog):
 
         # Statistics
         stats = []
-        stats.append('• ' + lib.get_string('info:servers', guild_id) + ': ' + format(len(self.bot.guilds)))
-        stats.append('• ' + lib.get_string('info:members', guild_id) + ': ' + format(self.count_members(self.bot.guilds)))
+        stats.append('• ' + lib.get_string('info:servers', guild_id) + ': ' + format(totals['guilds']))
+        stats.append('• ' + lib.get_string('info:members', guild_id) + ': ' + format(totals['members']))
         stats.append('• ' + lib.get_string('info:sprints', guild_id) + ': ' + str(sprints))
         stats.append('• ' + lib.get_string('info:helpserver', guild_id) + ': ' + config.help_server)
         stats = '\n'.join(stats)
 
         embed.add_field(name=lib.get_string('info:generalstats', guild_id), value=stats, inline=False)
 
-        # Developer Info
-        git = {}
-        git['branch'] = os.popen(r'git rev-parse --abbrev-ref HEAD').read().strip()
-        git['rev'] =  os.popen(r'git log --pretty=format:"%h | %ad | %s" --date=short -n 1').read().strip()
+        # Developer Info. Running git blocks, so do it on the I/O threads.
+        git = await lib.run_io(self.get_git_info)
 
         dev = []
         dev.append(lib.get_string('info:dev:branch', guild_id) + ': ' + format(git['branch']))
@@ -57,16 +56,15 @@ class About(commands.Cog):
         await context.send(embed=embed)
 
 
-    def count_members(self, guilds):
+    def get_git_info(self):
         """
-        Count all the members in every server this bot is in.
-        @param guilds: Passed from bot.guilds
-        @return int Total member count
+        Get the current branch and latest commit of the bot's code
+        @return dict
         """
-        total = 0
-        for guild in guilds:
-            total += len(guild.members)
-        return total
+        git = {}
+        git['branch'] = os.popen(r'git rev-parse --abbrev-ref HEAD').read().strip()
+        git['rev'] =  os.popen(r'git log --pretty=format:"%h | %ad | %s" --date=short -n 1').read().strip()
+        return git
 
 
 def setup(bot):
@@ -1,5 +1,7 @@
 import discord, lib
 from discord.ext import commands
+from structures.db import Database
+from structures.querylog import QueryLog
 from structures.user import User
 from structures.wrapper import CommandWrapper
 
@@ -7,7 +9,7 @@ class Admin(commands.Cog, CommandWrapper):
 
     def __init__(self, bot):
         self.bot = bot
-        self._supported_commands = ['status']
+        self._supported_commands = ['status', 'queries']
         self._arguments = [
             {
                 'key': 'cmd',
@@ -42,6 +44,8 @@ class Admin(commands.Cog, CommandWrapper):
 
         if cmd == 'status':
             return await self.run_status(context, opts)
+        elif cmd == 'queries':
+            return await self.run_queries(context, opts)
 
 
     async def run_status(self, context, opts):
@@ -53,5 +57,30 @@ class Admin(commands.Cog, CommandWrapper):
         status = " ".join(opts[0:])
         return await self.bot.change_presence(activity=discord.Game(status))
 
+    async def run_queries(self, context, opts):
+        """
+        Show the query shapes which have taken the most time in total, and the most built statements
+        :param opts: Optionally, the number of query shapes to show
+        :return:
+        """
+        limit = int(opts[0]) if opts and lib.is_number(opts[0]) else 5
+        log = QueryLog.instance()
+        stats = log.get_stats(limit)
+
+        if not stats:
+            return await context.send(lib.get_string('admin:queries:none', context.guild.id))
+
+        message = lib.get_string('admin:queries', context.guild.id).format(log.get_slow_count(), log.threshold) + '\n```'
+        for stat in stats:
+            message += '\n' + stat['sql'][:120] + '\n'
+            message += '  {count}x, total {total:.0f}ms, avg {avg:.1f}ms, p50 {p50:g}ms, p99 {p99:g}ms, max {max:.1f}ms, {rows:.1f} rows, {slow} slow, mostly {caller}\n'.format(**stat)
+
+        message += '\n'
+        for sql, count in Database.instance().get_statement_stats()[:limit]:
+            message += str(count) + 'x built: ' + sql[:100] + '\n'
+
+        # Keep within the message length limit
+        return await context.send(message[:1990] + '```')
+
 def setup(bot):
     bot.add_cog(Admin(bot))
\ No newline at end of file
@@ -24,7 +24,7 @@ class Help(commands.Cog, CommandWrapper):
             help_embed = discord.Embed(title="Help with Writer Bot", description="For more help with a command run `help [command]`", color=discord.Color.blurple())
             help_embed.add_field(name='`about`', value=lib.get_string('help:about', user.get_guild()), inline=True)
             help_embed.add_field(name='`ask`', value=lib.get_string('help:ask', user.get_guild()), inline=True)
-            help_embed.add_field(name='`challenge`', value=lib.get_string('help:challenge', user.get_guild), inline=True)
+            help_embed.add_field(name='`challenge`', value=lib.get_string('help:challenge', user.get_guild()), inline=True)
             help_embed.add_field(name='`8ball`', value=lib.get_string('help:8ball', user.get_guild()), inline=True)
             help_embed.add_field(name='`event`', value=lib.get_string('help:event', user.get_guild()), inline=True)
             help_embed.add_field(name='`flip`', value=lib.get_string('help:flip', user.get_guild()), inline=True)
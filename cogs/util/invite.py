@@ -10,7 +10,7 @@ class Invite(commands.Cog):
         """
         Displays an embed with and invite link
         """
-        config=lib.get('./settings.json')
+        config=await lib.get_async('./settings.json')
         invite_embed=discord.Embed(title='Invite Link', color=652430, url=config.invite_url)
         invite_embed.add_field(name='Click the title for the invite link!', value="Use the Above link to invite the bot to your servers!")
 
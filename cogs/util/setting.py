@@ -72,6 +72,11 @@ class Setting(commands.Cog, CommandWrapper):
 
 
         guild.update_setting(setting, value)
+
+        # The prefix is read from memory on every message, so that needs updating too.
+        if setting == 'prefix':
+            self.bot.set_prefix(guild.get_id(), value)
+
         return await context.send(user.get_mention() + ', ' + lib.get_string('setting:updated', guild.get_id()).format(setting, value))
 
 def setup(bot):
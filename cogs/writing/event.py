@@ -107,7 +107,7 @@ class EventCommand(commands.Cog, CommandWrapper):
 
         event.set_context(context)
 
-        return await context.send(embed=event.get_leaderboard(Event.LEADERBOARD_LIMIT))
+        return await context.send(embed=await event.get_leaderboard(Event.LEADERBOARD_LIMIT))
 
     async def run_unschedule(self, context):
         """
@@ -222,8 +222,8 @@ class EventCommand(commands.Cog, CommandWrapper):
         Task.cancel('event', event.get_id())
 
         # Schedule the tasks to run at those times.
-        Task.schedule(Event.TASKS['start'], event.get_start_time(), 'event', event.get_id())
-        Task.schedule(Event.TASKS['end'], event.get_end_time(), 'event', event.get_id())
+        Task.schedule(Event.TASKS['start'], event.get_start_time(), 'event', event.get_id(), event.get_guild())
+        Task.schedule(Event.TASKS['end'], event.get_end_time(), 'event', event.get_id(), event.get_guild())
 
         return await context.send(user.get_mention() + ', ' + lib.get_string('event:scheduled', user.get_guild()).format(event.get_title(), start, end))
 
@@ -389,7 +389,7 @@ class EventCommand(commands.Cog, CommandWrapper):
         """
         user = User(context.message.author.id, context.guild.id, context)
         event = Event.get_by_guild(user.get_guild())
-        config = lib.get('./settings.json')
+        config = await lib.get_async('./settings.json')
 
         # Make sure there is an event
         if event is None:
@@ -418,7 +418,7 @@ class EventCommand(commands.Cog, CommandWrapper):
             status = lib.get_string('event:notyetstarted', user.get_guild())
 
         # Get the number of users in the event and how many words they have written in it so far
-        writers = len(event.get_users())
+        writers = event.get_writer_count()
         words = event.get_total_wordcount()
 
         # Get the description of the event and add to the end of the status, or just display the status if the description is empty
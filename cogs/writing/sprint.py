@@ -44,7 +44,6 @@ class SprintCommand(commands.Cog, CommandWrapper):
         """
         Write with your friends and see who can write the most in the time limit!
         When choosing a length and start delay, there are maximums of 60 minutes length of sprint, and 24 hours delay until sprint begins.
-        NOTE: The bot checks for sprint changes every 30 seconds, so your start/end times might be off by +-30 seconds or so.
 
         Run `help sprint` for more extra information, including any custom server settings related to sprints.
 
@@ -532,11 +531,11 @@ class SprintCommand(commands.Cog, CommandWrapper):
         # Are we starting immediately or after a delay?
         if start == 0:
             # Immediately. That means we need to schedule the end task.
-            Task.schedule(sprint.TASKS['end'], end_time, 'sprint', sprint.get_id())
+            Task.schedule(sprint.TASKS['end'], end_time, 'sprint', sprint.get_id(), sprint.get_guild())
             return await sprint.post_start(context)
         else:
             # Delay. That means we need to schedule the start task, which will in turn schedule the end task once it's run.
-            Task.schedule(sprint.TASKS['start'], start_time, 'sprint', sprint.get_id())
+            Task.schedule(sprint.TASKS['start'], start_time, 'sprint', sprint.get_id(), sprint.get_guild())
             return await sprint.post_delayed_start(context)
 
 
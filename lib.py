@@ -1,8 +1,21 @@
-import json, math, os, pytz, random, string
+import asyncio, functools, json, math, os, pytz, random, string
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
 from os import path
 from datetime import datetime, timezone, timedelta, time
+from time import time as timestamp
+
+DEFAULT_LANG = 'en'
+LANG_RELOAD_CHECK = 10 # Seconds between checking the language packs for changes
+IO_THREADS = 2 # Threads for running blocking file reads off the event loop
+
+# Parsed language packs, the guild language lookups and the counters for them, kept for the life of the process
+_strings = {}
+_guild_langs = {}
+_string_stats = {'hits': 0, 'misses': 0, 'lang_hits': 0, 'lang_misses': 0, 'reloads': 0}
+_io_executor = None
+_config = None
 
 def get(file,as_object=True):
     """
@@ -18,14 +31,74 @@ def get(file,as_object=True):
         else:
             return json.load(data)
 
+def get_config():
+    """
+    Get the bot's settings. settings.json is only read the first time, after that they come from memory.
+    Any setting which might not be there should be read with getattr() and a default.
+    @return object
+    """
+    global _config
+    if _config is None:
+        _config = get(os.path.abspath(os.path.dirname(__file__)) + '/settings.json')
+
+    return _config
+
+async def get_async(file, as_object=True):
+    """
+    Awaitable version of get(), which reads and parses the file on the I/O thread pool instead of blocking the event loop
+    @param file: The path to the file to load
+    @param as_object: Return as an object (can be accessed via object.property). Otherwise object['property'].
+    @return object
+    """
+    return await run_io(get, file, as_object)
+
+async def run_io(func, *args):
+    """
+    Run a blocking I/O function on the I/O thread pool and wait for the result
+    @param func: The function to run
+    @param args: Arguments to pass to it
+    @return Whatever the function returns
+    """
+    global _io_executor
+    if _io_executor is None:
+        _io_executor = ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix='io')
+
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_io_executor, functools.partial(func, *args))
+
 def get_lang(guild_id):
     """
-    Check which language file the guild is using
+    Check which language file the guild is using.
+    The guild's `lang` setting is only looked up in the database the first time, after that it comes from memory.
     @param guild_id: The guild ID
     @return string: The language code
     """
-    # TODO: Look up guild language in DB
-    return 'en'
+    guild_id = is_number(guild_id)
+    if guild_id is False:
+        return DEFAULT_LANG
+
+    if guild_id in _guild_langs:
+        _string_stats['lang_hits'] += 1
+        return _guild_langs[guild_id]
+
+    _string_stats['lang_misses'] += 1
+
+    # Imported here, as the database module itself imports lib.
+    from structures.db import Database
+    setting = Database.instance().get('guild_settings', {'guild': guild_id, 'setting': 'lang'})
+
+    lang = setting['value'] if setting and is_supported_language(setting['value']) else DEFAULT_LANG
+    _guild_langs[guild_id] = lang
+    return lang
+
+def forget_lang(guild_id):
+    """
+    Remove the cached language of a guild, so it is looked up again the next time it is needed.
+    This should be called whenever the guild's `lang` setting is changed.
+    @param guild_id: The guild ID
+    @return void
+    """
+    _guild_langs.pop(is_number(guild_id), None)
 
 def get_supported_languages():
     """
@@ -50,29 +123,65 @@ def get_string(str, guild_id):
     @return string: The full string in the correct language
     """
 
-    lang = get_lang(guild_id)
-    path = f'./data/lang/{lang}.json'
-    strings = get(path, False)
-    return strings[str] if str in strings else f'[[{str}]]'
+    strings = get_strings(get_lang(guild_id))
+
+    if str in strings:
+        _string_stats['hits'] += 1
+        return strings[str]
+    else:
+        _string_stats['misses'] += 1
+        return f'[[{str}]]'
+
+def load_strings(lang=None):
+    """
+    Parse a language pack into memory. If no language is specified, load all of the supported ones.
+    @param lang: The language code
+    @return void
+    """
+    for code in ([lang] if lang is not None else get_supported_languages()):
+        file = f'./data/lang/{code}.json'
+        _strings[code] = {'strings': get(file, False), 'mtime': os.stat(file).st_mtime, 'checked': timestamp()}
+        _string_stats['reloads'] += 1
+
+def get_strings(lang):
+    """
+    Get the dictionary of strings for a language pack, loading it the first time it is needed.
+    Every LANG_RELOAD_CHECK seconds, the file is checked and reloaded if it has changed on disk.
+    @param lang: The language code
+    @return dict
+    """
+    pack = _strings.get(lang)
+
+    if pack is None:
+        load_strings(lang)
+    elif timestamp() - pack['checked'] > LANG_RELOAD_CHECK:
+        pack['checked'] = timestamp()
+        if os.stat(f'./data/lang/{lang}.json').st_mtime != pack['mtime']:
+            load_strings(lang)
+
+    return _strings[lang]['strings']
+
+def get_string_stats():
+    """
+    Get the counters for the language string lookups
+    @return dict
+    """
+    return dict(_string_stats, languages=len(_strings), guilds=len(_guild_langs))
 
 def get_asset(asset, guild_id):
     """
-    Load a JSON asset file, in the language of the guild_id
+    Get a JSON asset, in the language of the guild_id.
+    Assets are loaded once and then served from memory, so the returned lists are read-only tuples.
     :param asset:
     :param guild_id:
     :return:
     """
 
-    file = './assets/json/' + get_lang(guild_id) + '/' + asset + '.json'
+    # Imported here, as the asset store is only needed once something asks for an asset.
+    from structures.asset import AssetStore
 
     # Try and get the file in the server's language first. If not, default to 'en'
-    try:
-        if path.exists(file):
-            return get(file, False)
-        else:
-            return get('./assets/json/en/' + asset + '.json', False)
-    except FileNotFoundError:
-        return False
+    return AssetStore.instance().get(get_lang(guild_id), asset)
 
 
 def find_in_array(lst, key, value):
@@ -3,16 +3,39 @@ import discord, json, lib
 from bot import WriterBot
 from discord.ext import commands
 from pprint import pprint
+from structures.cluster import Cluster, ClusterClient
 
-# Load the settings for initial setup
-config = lib.get('./settings.json')
+def run_bot(cluster_id=None, shard_ids=None, shard_count=None, pipe=None):
+    """
+    Create the bot and run it. In cluster mode, this is run in each worker process with its own range of shards.
+    :param cluster_id:
+    :param shard_ids:
+    :param shard_count:
+    :param pipe: The worker's end of the pipe to the cluster supervisor
+    :return:
+    """
+    # Load the settings for initial setup
+    config = lib.get_config()
+    cluster = ClusterClient(cluster_id, pipe) if pipe is not None else None
 
-# Load the Bot object
-status = discord.Game( 'Booting up...' )
-bot = WriterBot(command_prefix=WriterBot.load_prefix, activity=status)
+    # Load the Bot object. Offline members can be left out of the member cache to save memory on large guilds, as names are cached separately.
+    status = discord.Game( 'Booting up...' )
+    bot = WriterBot(command_prefix=WriterBot.load_prefix, activity=status, fetch_offline_members=getattr(config, 'fetch_offline_members', True),
+                    shard_ids=shard_ids, shard_count=shard_count, cluster=cluster)
 
-# Load all commands
-bot.load_commands()
+    # Load all commands
+    bot.load_commands()
 
-# Start the bot
-bot.run(config.token)
\ No newline at end of file
+    # Start the bot
+    bot.run(config.token)
+
+if __name__ == '__main__':
+
+    config = lib.get_config()
+
+    # In cluster mode, the shards are split between several processes, run by a supervisor. Otherwise they all run in this one.
+    processes = int(getattr(config, 'cluster_processes', 0) or 0)
+    if processes > 1:
+        Cluster(run_bot, processes, int(getattr(config, 'shard_count', 0) or processes)).run()
+    else:
+        run_bot()
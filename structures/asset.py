@@ -0,0 +1,199 @@
+import json, lib, mmap, os, struct, sys
+from collections.abc import Sequence
+from structures.singleton import Singleton
+
+class MappedList(Sequence):
+    """
+    Read-only list of strings stored in a memory-mapped asset file.
+    Strings are only decoded when they are accessed, so the list itself takes up almost no memory.
+    """
+
+    def __init__(self, buffer, base, table, count):
+        self._buffer = buffer
+        self._base = base
+        self._table = base + table
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+
+        if index < 0:
+            index += self._count
+
+        if index < 0 or index >= self._count:
+            raise IndexError('MappedList index out of range')
+
+        start, end = struct.unpack_from('<II', self._buffer, self._table + (4 * index))
+        return self._buffer[self._base + start:self._base + end].decode('utf-8')
+
+@Singleton
+class AssetStore:
+    """
+    Registry of the JSON asset files, parsed once and then served from memory.
+    Lists are stored as tuples of interned strings. If the `asset_mmap` setting is enabled, any asset file larger than
+    MMAP_MIN_SIZE is compiled into a binary file in assets/cache/ and its string lists are read from a memory map instead.
+    """
+
+    DEFAULT_LANG = 'en'
+    MMAP_MIN_SIZE = 256 * 1024 # Bytes
+    MAGIC = b'WBA1'
+    MAPPED_KEY = '__mapped__'
+
+    def __init__(self):
+
+        self.__path = os.path.abspath(os.path.dirname(__file__) + '/../assets')
+        self.__assets = {}
+        self.__maps = []
+
+        self.use_mmap = bool(getattr(lib.get_config(), 'asset_mmap', False))
+
+    def load(self):
+        """
+        Load every asset file for every language
+        :return: int Number of assets loaded
+        """
+        for lang in os.listdir(self.__path + '/json'):
+            for file in os.listdir(self.__path + '/json/' + lang):
+                if file.endswith('.json'):
+                    self.load_asset(lang, file[:-5])
+
+        return len(self.__assets)
+
+    def load_asset(self, lang, asset):
+        """
+        Load a single asset file into the registry
+        :param lang:
+        :param asset:
+        :return: The loaded asset
+        """
+        file = self.__path + '/json/' + lang + '/' + asset + '.json'
+
+        if self.use_mmap and os.path.getsize(file) >= self.MMAP_MIN_SIZE:
+            data = self.load_mapped(file, self.__path + '/cache/' + lang + '/' + asset + '.bin')
+        else:
+            with open(file, 'r') as f:
+                data = self.freeze(json.load(f))
+
+        self.__assets[(lang, asset)] = data
+        return data
+
+    def get(self, lang, asset):
+        """
+        Get an asset in the given language, falling back to the default language if it doesn't exist
+        :param lang:
+        :param asset:
+        :return: The asset, or False if it doesn't exist in either language
+        """
+        for code in (lang, self.DEFAULT_LANG):
+
+            if (code, asset) in self.__assets:
+                return self.__assets[(code, asset)]
+
+            if os.path.exists(self.__path + '/json/' + code + '/' + asset + '.json'):
+                return self.load_asset(code, asset)
+
+        return False
+
+    def freeze(self, value):
+        """
+        Convert the parsed JSON into its compact form, with tuples instead of lists and interned strings
+        :param value:
+        :return:
+        """
+        if isinstance(value, str):
+            return sys.intern(value)
+        elif isinstance(value, list):
+            return tuple(self.freeze(item) for item in value)
+        elif isinstance(value, dict):
+            return {sys.intern(key): self.freeze(item) for key, item in value.items()}
+        else:
+            return value
+
+    def load_mapped(self, source, binary):
+        """
+        Load an asset from its compiled binary file, compiling it first if it is missing or out of date
+        :param source: Path to the JSON file
+        :param binary: Path to the compiled file
+        :return:
+        """
+        if not os.path.exists(binary) or os.path.getmtime(binary) < os.path.getmtime(source):
+            with open(source, 'r') as f:
+                self.compile(json.load(f), binary)
+
+        with open(binary, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.__maps.append(buffer)
+
+        length = struct.unpack_from('<I', buffer, len(self.MAGIC))[0]
+        base = len(self.MAGIC) + 4 + length
+        index = json.loads(buffer[len(self.MAGIC) + 4:base].decode('utf-8'))
+
+        return self.__unpack(index, buffer, base)
+
+    def compile(self, data, binary):
+        """
+        Write the asset out into the binary format.
+        The file is the MAGIC header, the length of the JSON index, the JSON index, and then the blob of strings.
+        In the index, every list of strings is replaced by the position of its offset table in the blob and its length.
+        :param data:
+        :param binary:
+        :return: void
+        """
+        blob = bytearray()
+
+        def pack(value):
+
+            if isinstance(value, list) and all(isinstance(item, str) for item in value):
+
+                encoded = [item.encode('utf-8') for item in value]
+                table = len(blob)
+                blob.extend(bytes(4 * (len(encoded) + 1)))
+
+                # Write each string, and its start offset into the table. The last entry is the end of the final string.
+                for i, item in enumerate(encoded):
+                    struct.pack_into('<I', blob, table + (4 * i), len(blob))
+                    blob.extend(item)
+                struct.pack_into('<I', blob, table + (4 * len(encoded)), len(blob))
+
+                return {self.MAPPED_KEY: [table, len(encoded)]}
+
+            elif isinstance(value, list):
+                return [pack(item) for item in value]
+            elif isinstance(value, dict):
+                return {key: pack(item) for key, item in value.items()}
+            else:
+                return value
+
+        index = json.dumps(pack(data)).encode('utf-8')
+
+        os.makedirs(os.path.dirname(binary), exist_ok=True)
+        with open(binary + '.tmp', 'wb') as f:
+            f.write(self.MAGIC)
+            f.write(struct.pack('<I', len(index)))
+            f.write(index)
+            f.write(blob)
+
+        os.replace(binary + '.tmp', binary)
+
+    def __unpack(self, value, buffer, base):
+        """
+        Rebuild the asset structure from the index, replacing the mapped entries with MappedList objects
+        :param value:
+        :param buffer:
+        :param base:
+        :return:
+        """
+        if isinstance(value, dict) and self.MAPPED_KEY in value:
+            return MappedList(buffer, base, *value[self.MAPPED_KEY])
+        elif isinstance(value, list):
+            return tuple(self.__unpack(item, buffer, base) for item in value)
+        elif isinstance(value, dict):
+            return {sys.intern(key): self.__unpack(item, buffer, base) for key, item in value.items()}
+        else:
+            return self.freeze(value)
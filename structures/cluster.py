@@ -0,0 +1,232 @@
+import itertools, lib, multiprocessing, signal, threading, time
+from multiprocessing.connection import wait
+
+class Cluster:
+    """
+    Supervisor for running the bot as several processes, each with its own contiguous range of shards, so one process
+    being blocked only holds up the guilds on its own shards.
+    The workers are started one at a time, spaced out so their shards don't identify with Discord at the same time,
+    and restarted if they exit. Each one has a pipe back to the supervisor, which it uses to report its stats and to
+    ask for the totals across every worker.
+    """
+
+    IDENTIFY_DELAY = 5 # Seconds between shards identifying with the gateway
+    START_TIMEOUT = 300 # Seconds to wait for a worker to finish its setup before starting the next one anyway
+    RESTART_DELAY = 10 # Seconds
+    POLL_INTERVAL = 1 # Seconds
+
+    def __init__(self, target, processes, shard_count):
+        """
+        :param target: Function to run in each worker, called with the cluster ID, shard IDs, shard count and the pipe
+        :param processes: Number of worker processes
+        :param shard_count: Total number of shards across all the workers
+        """
+        self.target = target
+        self.shard_count = int(shard_count)
+        self.context = multiprocessing.get_context('spawn')
+        self.workers = {}
+        self.stats = {}
+        self.stopping = False
+
+        # Split the shards into contiguous ranges, as evenly as possible
+        processes = max(1, min(int(processes), self.shard_count))
+        size, extra = divmod(self.shard_count, processes)
+        start = 0
+        self.shards = []
+        for i in range(processes):
+            end = start + size + (1 if i < extra else 0)
+            self.shards.append(list(range(start, end)))
+            start = end
+
+    def start_worker(self, cluster_id):
+        """
+        Start the worker process for a cluster
+        :param cluster_id:
+        :return: void
+        """
+        parent, child = self.context.Pipe()
+        process = self.context.Process(target=self.target, args=(cluster_id, self.shards[cluster_id], self.shard_count, child),
+                                       name='writerbot-cluster-' + str(cluster_id))
+        process.start()
+        child.close()
+
+        self.workers[cluster_id] = {'process': process, 'pipe': parent, 'started': False, 'restart': None}
+        lib.debug('[CLUSTER] Started cluster ' + str(cluster_id) + ' (pid ' + str(process.pid) + ') with shards ' + str(self.shards[cluster_id]))
+
+    def run(self):
+        """
+        Start the workers and supervise them until the supervisor is stopped
+        :return: void
+        """
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+
+        try:
+
+            # Start the workers one at a time, so the first one can run any database updates before the others start.
+            for cluster_id in range(len(self.shards)):
+
+                self.start_worker(cluster_id)
+                deadline = time.time() + self.START_TIMEOUT
+                while not self.stopping and not self.workers[cluster_id]['started'] and time.time() < deadline:
+                    self.poll()
+
+                delay = time.time() + self.IDENTIFY_DELAY * len(self.shards[cluster_id])
+                while not self.stopping and time.time() < delay:
+                    self.poll()
+
+            while not self.stopping:
+                self.poll()
+
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+
+    def poll(self):
+        """
+        Wait up to POLL_INTERVAL for a message from a worker or a worker exiting, and deal with it.
+        Also restart any workers which are due to be restarted.
+        :return: void
+        """
+        waiting = {}
+        for cluster_id, worker in self.workers.items():
+            if worker['restart'] is None:
+                waiting[worker['pipe']] = cluster_id
+                waiting[worker['process'].sentinel] = cluster_id
+
+        for ready in wait(list(waiting.keys()), self.POLL_INTERVAL):
+
+            cluster_id = waiting[ready]
+            worker = self.workers[cluster_id]
+
+            if ready is worker['pipe']:
+                try:
+                    self.handle(cluster_id, worker['pipe'].recv())
+                except (EOFError, OSError):
+                    pass
+
+            elif worker['restart'] is None and not worker['process'].is_alive():
+                self.worker_exited(cluster_id)
+
+        # Restart any workers whose delay is up
+        for cluster_id, worker in list(self.workers.items()):
+            if worker['restart'] is not None and time.time() >= worker['restart'] and not self.stopping:
+                self.start_worker(cluster_id)
+
+    def worker_exited(self, cluster_id):
+        """
+        Schedule a worker which has exited to be restarted
+        :param cluster_id:
+        :return: void
+        """
+        worker = self.workers[cluster_id]
+        worker['pipe'].close()
+        worker['restart'] = time.time() + self.RESTART_DELAY
+        self.stats.pop(cluster_id, None)
+
+        if not self.stopping:
+            lib.error('[CLUSTER] Cluster ' + str(cluster_id) + ' exited with code ' + str(worker['process'].exitcode) +
+                      ', restarting in ' + str(self.RESTART_DELAY) + ' seconds')
+
+    def handle(self, cluster_id, message):
+        """
+        Handle a message from a worker
+        :param cluster_id:
+        :param message: Tuple of the message type and its data
+        :return: void
+        """
+        type, data = message[0], message[1:]
+
+        # The worker has finished its setup
+        if type == 'started':
+            self.workers[cluster_id]['started'] = True
+
+        # The worker is reporting its stats
+        elif type == 'stats':
+            self.stats[cluster_id] = data[0]
+
+        # The worker wants the stats totalled across all the workers, sending its own up to date ones with the request
+        elif type == 'totals':
+            request_id, stats = data
+            self.stats[cluster_id] = stats
+            self.workers[cluster_id]['pipe'].send(('totals', request_id, self.get_totals()))
+
+    def get_totals(self):
+        """
+        Add up the last stats reported by each worker
+        :return: dict
+        """
+        totals = {}
+        for stats in self.stats.values():
+            for key, value in stats.items():
+                totals[key] = totals.get(key, 0) + value
+
+        totals['clusters'] = len(self.stats)
+        return totals
+
+    def stop(self):
+        self.stopping = True
+
+    def shutdown(self):
+        """
+        Stop all the workers
+        :return: void
+        """
+        self.stopping = True
+        for worker in self.workers.values():
+            if worker['process'].is_alive():
+                worker['process'].terminate()
+
+        for worker in self.workers.values():
+            worker['process'].join(self.RESTART_DELAY)
+
+class ClusterClient:
+    """
+    The worker's end of the pipe to the cluster supervisor.
+    Sending and receiving blocks, so anything running on the event loop should call these through lib.run_io().
+    """
+
+    TIMEOUT = 5 # Seconds to wait for the supervisor to reply
+
+    def __init__(self, cluster_id, pipe):
+        self.id = cluster_id
+        self.pipe = pipe
+        self.lock = threading.Lock()
+        self.requests = itertools.count(1)
+
+    def started(self):
+        """
+        Tell the supervisor this worker has finished its setup
+        :return: void
+        """
+        with self.lock:
+            self.pipe.send(('started',))
+
+    def report(self, stats):
+        """
+        Send this worker's stats to the supervisor
+        :param stats: dict
+        :return: void
+        """
+        with self.lock:
+            self.pipe.send(('stats', stats))
+
+    def get_totals(self, stats):
+        """
+        Get the stats added up across all the workers
+        :param stats: This worker's current stats, which are sent along with the request
+        :return: dict, or None if the supervisor didn't reply in time
+        """
+        with self.lock:
+
+            request_id = next(self.requests)
+            self.pipe.send(('totals', request_id, stats))
+
+            # Skip over any late replies to earlier requests which timed out
+            deadline = time.time() + self.TIMEOUT
+            while self.pipe.poll(max(0, deadline - time.time())):
+                message = self.pipe.recv()
+                if message[0] == 'totals' and message[1] == request_id:
+                    return message[2]
+
+        return None
@@ -1,54 +1,104 @@
-import sys, os, lib, pymysql, warnings
+import sys, os, lib, pymysql, warnings, asyncio, contextvars, functools, re, threading, time, aiomysql
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from structures.querylog import QueryLog
 from structures.singleton import Singleton
 
 # sys.path.append(os.path.abspath('../'))
 
-@Singleton
-class Database:
-
-    # Create database connection
-    def __init__(self):
-
-        self.__path = os.path.abspath(os.path.dirname(__file__))
-
-        # Load the connection configuration
-        config = lib.get(self.__path + '/../settings.json')
-        self.connection = pymysql.connect(host=config.db_host, user=config.db_user, passwd=config.db_pass, db=config.db_name, autocommit=True)
-
-        # Set the cursor to be used, with DictCursor so we can refer to results by their keys
-        self.cursor = self.connection.cursor(pymysql.cursors.DictCursor)
-
-    # Close connection on destruction of object
-    def __del__(self):
-        self.connection.close()
-
-    def install(self):
-
-        install_path = self.__path + '/../data/install/'
-
-        try:
-
-            for filename in os.listdir(install_path):
-
-                file = open(os.path.join(install_path, filename), 'r')
-                sql = file.read()
-
-                # Suppress warnings about the tables already existing
-                with warnings.catch_warnings():
-                    warnings.simplefilter('ignore')
-                    self.cursor.execute(sql)
-
-        except:
-            self.connection.rollback()
-            raise
-
-        else:
-            self.connection.commit()
-            return True
-
-    def __build_get(self, table, where=None, fields=['*'], sort=None):
-
-        params = []
+class QueryBuilder:
+    """
+    Builds the SQL and parameters for the simple queries shared by the Database and AsyncDatabase objects.
+    The SQL for each shape of query (the operation, table, columns and sorting) is only generated once, when its table
+    and columns are checked against the database schema, and after that it comes out of the statement cache.
+    """
+
+    STATEMENT_CACHE_SIZE = 1000
+    IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+    # Generated SQL and the number of times it has been used, by query shape, shared by every builder
+    _statements = {}
+    _statement_counts = {}
+
+    # Table name => set of column names, loaded from the database the first time it is needed
+    _schema = None
+
+    def load_schema(self):
+        """
+        Load the tables and columns which queries are allowed to use from the database.
+        This should be run again after the schema has been changed.
+        :return: dict
+        """
+        rows = Database.instance().get_all_sql('SELECT table_name AS tbl, column_name AS col FROM information_schema.columns WHERE table_schema = DATABASE()', [])
+
+        schema = {}
+        for row in rows:
+            schema.setdefault(row['tbl'], set()).add(row['col'])
+
+        QueryBuilder._schema = schema
+        return schema
+
+    def _check(self, table, columns=()):
+        """
+        Make sure the table and columns exist before we put them into any SQL.
+        If they aren't found, the schema is reloaded in case they have been added since, before giving up.
+        :param table:
+        :param columns:
+        :return: void
+        """
+        schema = QueryBuilder._schema
+        if schema is None or table not in schema or not schema[table].issuperset(columns):
+            schema = self.load_schema()
+
+        if table not in schema:
+            raise ValueError('Unknown table `' + str(table) + '`')
+
+        for column in columns:
+            if column not in schema[table]:
+                raise ValueError('Unknown column `' + str(column) + '` on table `' + table + '`')
+
+    def _statement(self, key, compiler, *args):
+        """
+        Get the SQL for a query shape from the cache, or compile it and add it to the cache
+        :param key: Tuple describing the shape of the query
+        :param compiler: Method to generate the SQL if it's not in the cache
+        :param args: Arguments for the compiler method
+        :return: str
+        """
+        sql = QueryBuilder._statements.get(key)
+        if sql is None:
+            sql = compiler(*args)
+            if len(QueryBuilder._statements) >= self.STATEMENT_CACHE_SIZE:
+                return sql
+            QueryBuilder._statements[key] = sql
+
+        QueryBuilder._statement_counts[key] = QueryBuilder._statement_counts.get(key, 0) + 1
+        return sql
+
+    def get_statement_stats(self):
+        """
+        Get the number of times each cached query shape has been built, most used first
+        :return: list of (sql, count) tuples
+        """
+        counts = [(QueryBuilder._statements[key], count) for key, count in QueryBuilder._statement_counts.items()]
+        return sorted(counts, key=lambda item: item[1], reverse=True)
+
+    def _build_get(self, table, where=None, fields=['*'], sort=None):
+
+        if isinstance(fields, str):
+            fields = [fields]
+
+        key = ('get', table, tuple(where) if where is not None else None, tuple(fields), tuple(sort) if sort is not None else None)
+        sql = self._statement(key, self._compile_get, table, where, fields, sort)
+        return sql, list(where.values()) if where is not None else []
+
+    def _compile_get(self, table, where, fields, sort):
+
+        # Plain column names are checked, but anything else (*, COUNT(id) as cnt, etc...) is left as written in the code
+        columns = [field for field in fields if self.IDENTIFIER.match(field)]
+        columns += list(where.keys()) if where is not None else []
+        columns += [order.split()[0] for order in sort] if sort is not None else []
+        self._check(table, columns)
 
         sql = 'SELECT ' + ', '.join(fields) + ' ' \
               'FROM ' + table + ' '
@@ -58,9 +108,8 @@ class Database:
 
             sql += 'WHERE '
 
-            for field, value in where.items():
+            for field in where.keys():
                 sql += field + ' = %s AND '
-                params.append(value)
 
             # Remove the last 'AND '
             sql = sql[:-4]
@@ -69,9 +118,15 @@ class Database:
         if sort is not None:
             sql += ' ORDER BY ' + ', '.join(sort)
 
-        self.cursor.execute(sql, params)
+        return sql
+
+    def _build_insert(self, table, params):
+        sql = self._statement(('insert', table, tuple(params)), self._compile_insert, table, params)
+        return sql, list(params.values())
+
+    def _compile_insert(self, table, params):
 
-    def __build_insert(self, table, params):
+        self._check(table, params.keys())
 
         # Create param placeholders to be used in the query
         placeholders = ['%s'] * len(params.values())
@@ -81,33 +136,46 @@ class Database:
         sql += 'VALUES '
         sql += '(' + ','.join(placeholders) + ') '
 
-        sql_params = list(params.values())
-        self.cursor.execute(sql, sql_params)
+        return sql
 
-    def __build_delete(self, table, params):
+    def _build_delete(self, table, params):
+        sql = self._statement(('delete', table, tuple(params)), self._compile_delete, table, params)
+        return sql, list(params.values())
+
+    def _compile_delete(self, table, params):
+
+        self._check(table, params.keys())
 
-        sql_params = []
         sql = 'DELETE FROM ' + table + ' WHERE '
 
-        for field, value in params.items():
+        for field in params.keys():
             sql += field + ' = %s AND '
-            sql_params.append(value)
 
         # Remove the last 'AND '
         sql = sql[:-4]
 
-        # Execute the query
-        self.cursor.execute(sql, sql_params)
+        return sql
 
-    def __build_update(self, table, params, where=None):
+    def _build_update(self, table, params, where=None):
+
+        key = ('update', table, tuple(params), tuple(where) if where is not None else None)
+        sql = self._statement(key, self._compile_update, table, params, where)
+
+        sql_params = list(params.values())
+        if where is not None:
+            sql_params += where.values()
+
+        return sql, sql_params
+
+    def _compile_update(self, table, params, where):
+
+        self._check(table, list(params.keys()) + (list(where.keys()) if where is not None else []))
 
-        sql_params = []
         sql = 'UPDATE ' + table + ' SET '
 
         # Set values
-        for field, value in params.items():
+        for field in params.keys():
             sql += field + ' = %s, '
-            sql_params.append(value)
 
         # Remove the last ', '
         sql = sql[:-2]
@@ -116,39 +184,505 @@ class Database:
         if where is not None:
             sql += ' WHERE '
 
-            for field, value in where.items():
+            for field in where.keys():
                 sql += field + ' = %s AND '
-                sql_params.append(value)
 
             # Remove the last 'AND '
             sql = sql[:-4]
 
-        # Execute the query
-        self.cursor.execute(sql, sql_params)
+        return sql
+
+    def _build_insert_many(self, table, rows):
+
+        # All the rows must have the same columns as the first one
+        columns = tuple(rows[0].keys())
+        sql = self._statement(('insert_many', table, columns), self._compile_insert_many, table, columns)
+
+        # Only the start of the query is cached, as the number of rows changes from call to call, so they are added here
+        placeholders = '(' + ','.join(['%s'] * len(columns)) + ')'
+        sql += ','.join([placeholders] * len(rows))
+
+        sql_params = [row[column] for row in rows for column in columns]
+        return sql, sql_params
+
+    def _compile_insert_many(self, table, columns):
+
+        self._check(table, columns)
+
+        sql = 'INSERT INTO ' + table + ' '
+        sql += '(' + ','.join(columns) + ') '
+        sql += 'VALUES '
+
+        return sql
+
+    def _build_update_many(self, table, values, key='id', increment=False):
+
+        sql_params = []
+        sql = 'UPDATE ' + table + ' SET '
+
+        # Find every column being updated on any of the rows
+        columns = []
+        for row in values.values():
+            columns += [column for column in row.keys() if column not in columns]
+
+        # Which rows have which columns changes from call to call, so this SQL isn't cached, but it is still checked
+        self._check(table, columns + [key])
+
+        # Each column gets a CASE, picking out the value for each row by its key
+        for column in columns:
+
+            sql += column + ' = ' + (column + ' + ' if increment else '') + 'CASE ' + key + ' '
+
+            for key_value, row in values.items():
+                if column in row:
+                    sql += 'WHEN %s THEN %s '
+                    sql_params += [key_value, row[column]]
+
+            sql += 'ELSE ' + ('0' if increment else column) + ' END, '
+
+        # Remove the last ', '
+        sql = sql[:-2]
+
+        sql += ' WHERE ' + key + ' IN (' + ','.join(['%s'] * len(values)) + ')'
+        sql_params += list(values.keys())
+
+        return sql, sql_params
+
+    def _build_upsert(self, table, rows, conflict_keys, increment=False):
+
+        columns = tuple(rows[0].keys())
+        incremented = columns if increment is True else tuple(increment or [])
+
+        # Insert the rows, and if any clash with an existing row on its unique key, update that row instead
+        sql, sql_params = self._build_insert_many(table, rows)
+
+        key = ('upsert', table, columns, tuple(conflict_keys), incremented)
+        sql += self._statement(key, self._compile_upsert, columns, conflict_keys, incremented)
+
+        return sql, sql_params
+
+    def _compile_upsert(self, columns, conflict_keys, incremented):
+
+        sql = ' ON DUPLICATE KEY UPDATE '
+
+        # Every column outside the key gets the new value, or has it added on if we are incrementing
+        updates = []
+        for column in columns:
+            if column not in conflict_keys:
+                updates.append(column + ' = ' + (column + ' + ' if column in incremented else '') + 'VALUES(' + column + ')')
+
+        # If there is nothing to update, the existing row is left as it is
+        if not updates:
+            updates.append(conflict_keys[0] + ' = ' + conflict_keys[0])
+
+        sql += ', '.join(updates)
+        return sql
+
+@Singleton
+class Database(QueryBuilder):
+    """
+    Each thread using the Database gets its own connection, so the same object can be used from the event loop and
+    from the worker threads AsyncDatabase runs queries on in executor mode.
+    """
+
+    # Create database connection
+    def __init__(self):
+
+        self.__path = os.path.abspath(os.path.dirname(__file__))
+
+        # Load the connection configuration
+        self.config = lib.get_config()
+        self.__local = threading.local()
+        self.__connections = []
+        self.__connections_lock = threading.Lock()
+
+        # Connect straight away on the thread creating the object
+        self.connection
+
+    @property
+    def connection(self):
+        """
+        Get the connection for the current thread, connecting the first time it is needed
+        :return: pymysql.Connection
+        """
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None:
+
+            connection = pymysql.connect(host=self.config.db_host, user=self.config.db_user, password=self.config.db_pass, database=self.config.db_name, autocommit=True)
+            self.__local.connection = connection
+
+            # Set the cursor to be used, with DictCursor so we can refer to results by their keys
+            self.__local.cursor = connection.cursor(pymysql.cursors.DictCursor)
+
+            with self.__connections_lock:
+                self.__connections.append(connection)
+
+        return connection
+
+    @property
+    def cursor(self):
+        """
+        Get the cursor for the current thread's connection
+        :return: pymysql.cursors.DictCursor
+        """
+        self.connection
+        return self.__local.cursor
+
+    # Close connections on destruction of object
+    def __del__(self):
+        for connection in self.__connections:
+            connection.close()
+
+    def install(self):
+
+        install_path = self.__path + '/../data/install/'
+
+        try:
+
+            for filename in os.listdir(install_path):
+
+                file = open(os.path.join(install_path, filename), 'r')
+                sql = file.read()
+
+                # Suppress warnings about the tables already existing
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    self.cursor.execute(sql)
+
+        except:
+            self.connection.rollback()
+            raise
+
+        else:
+            self.connection.commit()
+            return True
+
+    def _execute(self, sql, params):
+        """
+        Run a query on the cursor, recording how long it took in the query log
+        :param sql:
+        :param params:
+        :return:
+        """
+        start = time.perf_counter()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            QueryLog.instance().record(sql, time.perf_counter() - start, self.cursor.rowcount)
 
     def get(self, table, where=None, fields=['*'], sort=None):
-        self.__build_get(table, where, fields, sort)
+        self._execute(*self._build_get(table, where, fields, sort))
         return self.cursor.fetchone()
 
     def get_all(self, table, where=None, fields=['*'], sort=None):
-        self.__build_get(table, where, fields, sort)
+        self._execute(*self._build_get(table, where, fields, sort))
         return self.cursor.fetchall()
 
     def get_all_sql(self, sql, params):
-        self.cursor.execute(sql, params)
+        self._execute(sql, params)
         return self.cursor.fetchall()
 
     def insert(self, table, params):
-        self.__build_insert(table, params)
+        self._execute(*self._build_insert(table, params))
+        return self.cursor.rowcount
+
+    def insert_many(self, table, rows):
+        if not rows:
+            return 0
+        self._execute(*self._build_insert_many(table, rows))
         return self.cursor.rowcount
 
     def delete(self, table, params):
-        self.__build_delete(table, params)
+        self._execute(*self._build_delete(table, params))
         return self.cursor.rowcount
 
     def update(self, table, params, where=None):
-        self.__build_update(table, params, where)
+        self._execute(*self._build_update(table, params, where))
+        return self.cursor.rowcount
+
+    def update_many(self, table, values, key='id', increment=False):
+        if not values:
+            return 0
+        self._execute(*self._build_update_many(table, values, key, increment))
+        return self.cursor.rowcount
+
+    def upsert(self, table, values, conflict_keys, increment=False):
+        """
+        Insert a row, or update the existing row if it clashes on a unique key, in one statement
+        :param table:
+        :param values: dict of column => value
+        :param conflict_keys: The columns of the unique key, which are not updated
+        :param increment: True to add the values on to all the other columns, or a list of the columns to add on to
+        :return: Number of rows affected (1 for an insert, 2 for an update)
+        """
+        self._execute(*self._build_upsert(table, [values], conflict_keys, increment))
+        return self.cursor.rowcount
+
+    def upsert_many(self, table, rows, conflict_keys, increment=False):
+        if not rows:
+            return 0
+        self._execute(*self._build_upsert(table, rows, conflict_keys, increment))
         return self.cursor.rowcount
 
     def execute(self, sql, params):
-        return self.cursor.execute(sql, params)
+        return self._execute(sql, params)
+
+    def last_insert_id(self):
+        return self.cursor.lastrowid
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run the queries inside the `with` block in a transaction, rolling it back if anything goes wrong.
+        Nothing inside the block should await, as any other query run on the connection in the meantime would become part of it.
+        If a transaction is already running on this thread, the block just becomes part of it.
+        :return:
+        """
+        if getattr(self.__local, 'transaction', False):
+            yield self
+            return
+
+        self.connection.begin()
+        self.__local.transaction = True
+        try:
+            yield self
+        except:
+            self.connection.rollback()
+            raise
+        else:
+            self.connection.commit()
+        finally:
+            self.__local.transaction = False
+
+@Singleton
+class AsyncDatabase(QueryBuilder):
+    """
+    Awaitable version of the Database object, backed by a pool of aiomysql connections.
+    Queries run through this object do not block the event loop while they wait on the database server.
+    """
+
+    POOL_MIN_SIZE = 1
+    POOL_MAX_SIZE = 10
+    EXECUTOR_THREADS = 4
+    POOL_ACQUIRE_TIMEOUT = 10 # Seconds
+    POOL_RECYCLE = 3600 # Seconds
+    HEALTH_CHECK_INTERVAL = 60 # Seconds
+
+    # MySQL client error codes meaning the connection has gone away, so we can reconnect and try again
+    RECONNECT_ERRORS = (2006, 2013, 2055)
+
+    def __init__(self):
+
+        self.__pool = None
+        self.__lock = asyncio.Lock()
+        self.__last_used = {}
+
+        # Load the connection and pool configuration
+        self.config = lib.get_config()
+        self.min_size = int(getattr(self.config, 'db_pool_min', self.POOL_MIN_SIZE))
+        self.max_size = int(getattr(self.config, 'db_pool_max', self.POOL_MAX_SIZE))
+        self.timeout = float(getattr(self.config, 'db_pool_timeout', self.POOL_ACQUIRE_TIMEOUT))
+
+        # In executor mode, queries are run with pymysql on a pool of worker threads instead of through aiomysql.
+        # This is for moving code over gradually: any blocking Database code can also be run on the threads with call().
+        self.use_executor = bool(getattr(self.config, 'db_executor', False))
+        self.threads = int(getattr(self.config, 'db_executor_threads', self.EXECUTOR_THREADS))
+        self.__executor = None
+
+    async def pool(self):
+        """
+        Get the connection pool, creating it the first time it is needed
+        :return: aiomysql.Pool
+        """
+        if self.__pool is None:
+            async with self.__lock:
+                if self.__pool is None:
+                    self.__pool = await aiomysql.create_pool(minsize=self.min_size, maxsize=self.max_size,
+                                                             pool_recycle=self.POOL_RECYCLE, host=self.config.db_host,
+                                                             user=self.config.db_user, password=self.config.db_pass,
+                                                             db=self.config.db_name, autocommit=True)
+        return self.__pool
+
+    async def acquire(self):
+        """
+        Acquire a healthy connection from the pool, waiting at most self.timeout seconds for one to become free
+        :return: aiomysql.Connection
+        """
+        pool = await self.pool()
+        connection = await asyncio.wait_for(pool.acquire(), self.timeout)
+
+        # If the connection has been sitting idle for a while, make sure it is still alive before we use it.
+        now = time.time()
+        if now - self.__last_used.get(id(connection), now) > self.HEALTH_CHECK_INTERVAL:
+            try:
+                await connection.ping(reconnect=True)
+            except:
+                pool.release(connection)
+                raise
+
+        return connection
+
+    def release(self, connection):
+        """
+        Return a connection to the pool
+        :param connection:
+        :return: void
+        """
+        if connection.closed:
+            self.__last_used.pop(id(connection), None)
+        else:
+            self.__last_used[id(connection)] = time.time()
+
+        self.__pool.release(connection)
+
+    def executor(self):
+        """
+        Get the thread pool for running blocking database code, creating it the first time it is needed
+        :return: ThreadPoolExecutor
+        """
+        if self.__executor is None:
+            self.__executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='db')
+        return self.__executor
+
+    async def call(self, func, *args, **kwargs):
+        """
+        Run a blocking function which uses the Database, e.g. a structure method, on one of the database threads.
+        Each thread has its own connection, so it doesn't interfere with queries being run on the event loop.
+        :param func:
+        :param args:
+        :param kwargs:
+        :return: Whatever the function returns
+        """
+        # Run it in a copy of the current context, so the query log still knows which command or task ran the queries
+        loop = asyncio.get_event_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self.executor(), functools.partial(context.run, func, *args, **kwargs))
+
+    def __run_threaded(self, sql, params, fetch):
+        """
+        Run a query on the current worker thread's connection, checking it is still alive if it has been idle
+        :param sql:
+        :param params:
+        :param fetch:
+        :return:
+        """
+        db = Database.instance()
+
+        now = time.time()
+        connection = db.connection
+        if now - self.__last_used.get(id(connection), now) > self.HEALTH_CHECK_INTERVAL:
+            connection.ping(reconnect=True)
+        self.__last_used[id(connection)] = now
+
+        result = db.execute(sql, params)
+        if fetch == 'one':
+            return db.cursor.fetchone()
+        elif fetch == 'all':
+            return db.cursor.fetchall()
+        else:
+            return result
+
+    async def run(self, sql, params, fetch=None):
+        """
+        Run a query on a pooled connection, reconnecting once if the server has dropped the connection
+        :param sql:
+        :param params:
+        :param fetch: 'one', 'all' or None to return the rowcount
+        :return:
+        """
+        if self.use_executor:
+            return await self.call(self.__run_threaded, sql, params, fetch)
+
+        for attempt in range(2):
+
+            connection = await self.acquire()
+            try:
+                async with connection.cursor(aiomysql.DictCursor) as cursor:
+
+                    start = time.perf_counter()
+                    try:
+                        await cursor.execute(sql, params)
+                    finally:
+                        QueryLog.instance().record(sql, time.perf_counter() - start, cursor.rowcount)
+
+                    if fetch == 'one':
+                        return await cursor.fetchone()
+                    elif fetch == 'all':
+                        return await cursor.fetchall()
+                    else:
+                        return cursor.rowcount
+
+            except pymysql.err.OperationalError as e:
+                # Close the dead connection so the pool discards it, then try again with a fresh one.
+                connection.close()
+                if attempt > 0 or e.args[0] not in self.RECONNECT_ERRORS:
+                    raise
+
+            finally:
+                self.release(connection)
+
+    async def get(self, table, where=None, fields=['*'], sort=None):
+        sql, params = self._build_get(table, where, fields, sort)
+        return await self.run(sql, params, 'one')
+
+    async def get_all(self, table, where=None, fields=['*'], sort=None):
+        sql, params = self._build_get(table, where, fields, sort)
+        return await self.run(sql, params, 'all')
+
+    async def get_all_sql(self, sql, params):
+        return await self.run(sql, params, 'all')
+
+    async def insert(self, table, params):
+        return await self.run(*self._build_insert(table, params))
+
+    async def insert_many(self, table, rows):
+        if not rows:
+            return 0
+        return await self.run(*self._build_insert_many(table, rows))
+
+    async def delete(self, table, params):
+        return await self.run(*self._build_delete(table, params))
+
+    async def update(self, table, params, where=None):
+        return await self.run(*self._build_update(table, params, where))
+
+    async def update_many(self, table, values, key='id', increment=False):
+        if not values:
+            return 0
+        return await self.run(*self._build_update_many(table, values, key, increment))
+
+    async def upsert(self, table, values, conflict_keys, increment=False):
+        return await self.run(*self._build_upsert(table, [values], conflict_keys, increment))
+
+    async def upsert_many(self, table, rows, conflict_keys, increment=False):
+        if not rows:
+            return 0
+        return await self.run(*self._build_upsert(table, rows, conflict_keys, increment))
+
+    async def execute(self, sql, params):
+        return await self.run(sql, params)
+
+    def get_pool_stats(self):
+        """
+        Get how many connections the pool has open and free
+        :return: dict, or None if the pool hasn't been created
+        """
+        if self.__pool is None:
+            return None
+        return {'size': self.__pool.size, 'free': self.__pool.freesize, 'max': self.__pool.maxsize}
+
+    async def close(self):
+        """
+        Close all the connections in the pool, and stop the executor threads
+        :return: void
+        """
+        if self.__pool is not None:
+            self.__pool.close()
+            await self.__pool.wait_closed()
+            self.__pool = None
+            self.__last_used = {}
+
+        # Waiting for the queries already queued on the threads to finish blocks, so do it off the loop
+        if self.__executor is not None:
+            executor, self.__executor = self.__executor, None
+            await asyncio.get_event_loop().run_in_executor(None, executor.shutdown, True)
@@ -1,17 +1,37 @@
 import discord, lib, time
 from structures.db import Database
+from structures.guild import Guild
+from structures.names import NameCache
+from structures.unitofwork import UnitOfWork
 from structures.user import User
 
 class Event:
 
     DEFAULT_COLOUR = 15105570
     LEADERBOARD_LIMIT = 10
+    LEADERBOARD_PAGE = 50 # Rows to read at a time when building the leaderboard
     TASKS = {
         'start': 'start',  # This is the task for starting the event
         'end': 'end',  # This is the task for ending the event
     }
 
+    def __new__(cls, id):
+
+        # If this event has already been loaded in the current command or task, use the same object
+        unit = UnitOfWork.current()
+        if unit is not None:
+            event = unit.get(('event', int(id)))
+            if event is not None:
+                return event
+
+        return super().__new__(cls)
+
     def __init__(self, id):
+
+        # If this is an object from the unit of work, it is already loaded
+        if getattr(self, 'id', None) is not None:
+            return
+
         self.__db = Database.instance()
         self.__bot = None
         self.__context = None
@@ -27,6 +47,8 @@ class Event:
         self.enddate = None
         self.started = None
         self.ended = None
+        self.writers = 0
+        self.total_words = 0
 
         record = self.__db.get('events', {'id': id})
         if record:
@@ -41,6 +63,12 @@ class Event:
             self.enddate = record['enddate']
             self.started = record['started']
             self.ended = record['ended']
+            self.writers = int(record['writers'])
+            self.total_words = int(record['total_words'])
+
+            unit = UnitOfWork.current()
+            if unit is not None:
+                unit.add(('event', int(self.id)), self)
 
     def is_valid(self):
         """
@@ -289,7 +317,7 @@ class Event:
         self.set_ended(now)
         self.save()
         await self.say( lib.get_string('event:ended', self.get_guild()).format(self.get_title()) )
-        await self.say(self.get_leaderboard(), embed=True)
+        await self.say(await self.get_leaderboard(), embed=True)
 
     def get_wordcount(self, user_id):
         """
@@ -305,34 +333,93 @@ class Event:
 
     def update_wordcount(self, user_id, amount):
         """
-        Update the event word count for a user
+        Update the event word count for a user, and the event's totals along with it
         :param user_id:
         :param amount:
         :return:
         """
-        record = self.__db.get('user_events', {'user': user_id, 'event': self.get_id()})
-        if record:
-            return self.__db.update('user_events', {'words': amount}, {'id': record['id']})
-        else:
-            return self.__db.insert('user_events', {
-                'event': self.get_id(),
-                'user': user_id,
-                'words': amount
-            })
+        with self.__db.transaction() as db:
+
+            # Lock their row while we work out how much it changes the total by
+            record = db.get_all_sql('SELECT words FROM user_events WHERE event = %s AND user = %s FOR UPDATE', [self.get_id(), user_id])
+            current = int(record[0]['words']) if record else 0
+
+            result = db.upsert('user_events', {'event': self.get_id(), 'user': user_id, 'words': amount}, ['event', 'user'])
+            self.add_to_totals(0 if record else 1, int(amount) - current)
+
+        return result
 
     def add_words(self, user_id, amount):
         """
-        Add to the user's word count for the event
+        Add to the user's word count for the event, and the event's totals along with it
         :param user_id:
         :param amount:
         :return:
         """
-        amount = int(amount)
-        record = self.__db.get('user_events', {'user': user_id, 'event': self.get_id()})
-        if record:
-            amount = int(record['words']) + amount
+        with self.__db.transaction() as db:
+
+            # The upsert affects 1 row if it inserted a new writer, or 2 if it updated an existing one
+            result = db.upsert('user_events', {'event': self.get_id(), 'user': user_id, 'words': int(amount)}, ['event', 'user'], increment=['words'])
+            self.add_to_totals(1 if result == 1 else 0, int(amount))
 
-        return self.update_wordcount(user_id, amount)
+        return result
+
+    def add_words_many(self, amounts):
+        """
+        Add to the word counts of several users on the event at once, and the event's totals along with them
+        :param amounts: dict of user_id => amount
+        :return:
+        """
+        ids = list(amounts.keys())
+        rows = [{'event': self.get_id(), 'user': user_id, 'words': int(amount)} for user_id, amount in amounts.items()]
+
+        with self.__db.transaction() as db:
+
+            # Lock the rows which already exist, so we know how many new writers there are
+            existing = db.get_all_sql('SELECT user FROM user_events WHERE event = %s AND user IN (' + ', '.join(['%s'] * len(ids)) + ') FOR UPDATE', [self.get_id()] + ids)
+
+            result = db.upsert_many('user_events', rows, ['event', 'user'], increment=['words'])
+            self.add_to_totals(len(ids) - len(existing), sum(int(amount) for amount in amounts.values()))
+
+        return result
+
+    def add_to_totals(self, writers, words):
+        """
+        Add on to the event's writer count and total word count
+        :param writers:
+        :param words:
+        :return:
+        """
+        if writers == 0 and words == 0:
+            return 0
+
+        result = self.__db.execute('UPDATE events SET writers = writers + %s, total_words = total_words + %s WHERE id = %s', [writers, words, self.get_id()])
+        self.writers += writers
+        self.total_words += words
+        return result
+
+    def repair_totals():
+        """
+        Recalculate the writer count and total word count of every event which hasn't ended, from their user_events rows.
+        This puts them right if they have drifted, e.g. from rows being changed by hand.
+        :return: Number of events changed
+        """
+        db = Database.instance()
+        return db.execute('UPDATE events e SET '
+                          'writers = (SELECT COUNT(*) FROM user_events u WHERE u.event = e.id), '
+                          'total_words = (SELECT COALESCE(SUM(u.words), 0) FROM user_events u WHERE u.event = e.id) '
+                          'WHERE e.ended = 0', [])
+
+    async def task_repair(bot):
+        """
+        Run the recurring task to repair the event totals
+        :param bot:
+        :return: bool
+        """
+        changed = Event.repair_totals()
+        if changed:
+            lib.debug('[EVENT] Repaired the totals of ' + str(changed) + ' events')
+        return True
 
     async def say(self, message, embed=False):
         """
@@ -380,17 +467,26 @@ class Event:
         Get the total word count in this event
         :return:
         """
-        record = self.__db.get('user_events', {'event': self.id}, ['SUM(words) as total'])
-        return int(record['total']) if record['total'] is not None else 0
+        return self.total_words
 
-    def get_leaderboard(self, limit=None):
+    def get_writer_count(self):
+        """
+        Get the number of users taking part in this event
+        :return:
+        """
+        return self.writers
+
+    async def get_leaderboard(self, limit=None):
         """
         Build the embedded leaderboard to display
         :return:
         """
 
         config = lib.get('./settings.json')
-        users = self.get_users()
+        users = self.get_leaderboard_users(limit)
+
+        # Make sure we have everyone's names before building it
+        await NameCache.instance().fetch(self.get_discord_guild(), [user['user'] for user in users])
 
         # Build the embedded leaderboard message
         title = self.get_title() + ' ' + lib.get_string('event:leaderboard', self.get_guild())
@@ -423,21 +519,60 @@ class Event:
             # Get the user and pass in the bot, so we can get their guild nickname
             user_object = User(user['user'], self.get_guild(), context=self.__context, bot=self.__bot)
 
-            # Easiest way to check if the user is still a member of the guild, is to see if we can get their nickname
-            if user_object.is_guild_member():
-
-                # Build the name and words variables to display in the list
-                name = str(position) + '. ' + user_object.get_name()
-                words = str(user['words'])
+            # Build the name and words variables to display in the list
+            name = str(position) + '. ' + str(user_object.get_name())
+            words = str(user['words'])
 
-                # Embed this user result as a field
-                embed.add_field(name=name, value=words, inline=False)
+            # Embed this user result as a field
+            embed.add_field(name=name, value=words, inline=False)
 
-                # Increment position
-                position += 1
+            # Increment position
+            position += 1
 
         return embed
 
+    def get_discord_guild(self):
+        """
+        Get the discord.Guild object for the event's guild, from the context or the bot if we have either
+        :return: discord.Guild or None
+        """
+        if self.__context is not None:
+            return self.__context.guild
+        elif self.__bot is not None:
+            return self.__bot.get_guild(int(self.get_guild()))
+        else:
+            return None
+
+    def get_leaderboard_users(self, limit=None):
+        """
+        Get the users at the top of the event who are still members of the guild, ordered by words written descending.
+        The rows are read a page at a time in order, and checked against the guild's cached member set, until there are
+        enough, so only the top of the leaderboard is read however many people have taken part.
+        :param limit:
+        :return: list of user_events rows
+        """
+        guild = self.get_discord_guild()
+        members = Guild.get_member_ids(guild) if guild is not None else set()
+        page = max(limit or 0, self.LEADERBOARD_PAGE)
+        offset = 0
+        users = []
+
+        while True:
+
+            records = self.__db.get_all_sql('SELECT user, words FROM user_events WHERE event = %s ORDER BY words DESC LIMIT %s OFFSET %s', [self.id, page, offset])
+
+            for record in records:
+                if int(record['user']) in members:
+                    users.append(record)
+                    if limit is not None and len(users) >= limit:
+                        return users
+
+            # If that was the last page, there is nobody else to check
+            if len(records) < page:
+                return users
+
+            offset += page
+
     def _task_prechecks(self, bot):
         """
         Run pre-task checks before attempting to run whichever scheduled task it is
@@ -1,11 +1,23 @@
-import lib
+import lib, time
 from operator import itemgetter
-from structures.db import Database
+from structures.db import AsyncDatabase, Database
+from structures.names import NameCache
 from structures.user import User
 
 class Guild:
 
     TOP_LIMIT = 10
+    MEMBER_CACHE_TIME = 600 # Seconds before a guild's member set is rebuilt from the member list
+    TOP_XP_CACHE_TIME = 3600 # Seconds before a guild's top XP list is loaded again, even if no XP changes were seen
+    CLUSTER_TOP_XP_CACHE_TIME = 30 # Seconds to keep a top XP list in cluster mode, where XP changes on other workers aren't seen
+    TOP_XP_PAGE = 20 # Rows to read at a time when building the top XP list
+    SYNC_BATCH_SIZE = 1000 # Rows per query when syncing the guild_members table
+
+    # Set of member IDs for each guild, by guild ID, kept up to date by the member join and leave events
+    _member_ids = {}
+
+    # The top XP users of each guild, by guild ID, as (user, xp) tuples. Dropped when someone's XP could change it.
+    _top_xp = {}
 
     def __init__(self, guild):
 
@@ -13,15 +25,11 @@ class Guild:
         self.__db = Database.instance()
         self._guild = guild
         self._id = guild.id
-        self._members = [member.id for member in self._guild.members]
         self._settings = None
 
     def get_id(self):
         return self._id
 
-    def get_members_in_sql(self):
-        return ', '.join(str(m) for m in self._members)
-
     def get_settings(self):
 
         # If the settings property is None, then load it up first
@@ -56,35 +64,198 @@ class Guild:
 
     def update_setting(self, setting, value):
 
-        # If the user already has a value for this setting, we want to update
-        user_setting = self.get_setting(setting)
+        # If the language is changing, make sure the old one isn't still used from memory.
+        if setting == 'lang':
+            lib.forget_lang(self._id)
 
-        if user_setting:
-            return self.__db.update('guild_settings', {'value': value}, {'guild': self._id, 'setting': setting})
+        # If we have already loaded the settings, update the value in the array
+        if self._settings is not None:
+            self._settings[setting] = value
 
-        # Otherwise, we want to insert a new one
-        else:
-            return self.__db.insert('guild_settings', {'guild': self._id, 'setting': setting, 'value': value})
+        return self.__db.upsert('guild_settings', {'guild': self._id, 'setting': setting, 'value': value}, ['guild', 'setting'])
 
-    def get_top_xp(self):
+    async def get_top_xp(self):
         """
-        Get the top {self.TOP_LIMIT} users in a guild, ordered by their XP
+        Get the top {self.TOP_LIMIT} users in a guild, ordered by their XP, with their names loaded.
+        The list is kept in memory until the XP of someone who could be on it changes, or get_top_xp_cache_time() is up.
         :return: array
         """
+        names = NameCache.instance()
+        cached = Guild._top_xp.get(self._id)
 
-        # Build the SQL query using the IDs of the guild members
-        sql = 'SELECT user FROM user_xp WHERE user IN (' + self.get_members_in_sql() + ') ORDER BY xp DESC LIMIT ' + str(self.TOP_LIMIT)
-        self.__db.cursor.execute(sql)
-        results = self.__db.cursor.fetchall()
+        # Anyone Discord says isn't a member any more is taken out of the membership table, so it doesn't keep returning them
+        left = []
 
+        if cached is not None and time.time() - cached['built'] <= Guild.get_top_xp_cache_time():
+            left += await names.fetch(self._guild, [user_id for user_id, xp in cached['users']])
+            users = [(user_id, names.resolve(self._id, user_id, self._guild)) for user_id, xp in cached['users']]
+
+            # If anyone on the list has left since it was built, build it again so their place is filled
+            if all(name is not None for user_id, name in users):
+                return [User(user_id, self._id, None, name) for user_id, name in users]
+
+        # Join the XP onto the guild's rows in the membership table, rather than listing every member ID in the query
+        sql = 'SELECT x.user, x.xp FROM guild_members m INNER JOIN user_xp x ON x.user = m.user ' \
+              'WHERE m.guild = %s ORDER BY x.xp DESC LIMIT %s OFFSET %s'
+        offset = 0
+        top = []
         users = []
-        for user in results:
-            guild_member = self._guild.get_member( int(user['user']) )
-            usr = User(user['user'], self._id, None, guild_member.display_name)
-            users.append( usr )
 
+        # Read the rows a page at a time, skipping anyone who has left since the membership table was last synced, until there are enough
+        while len(users) < self.TOP_LIMIT:
+
+            results = self.__db.get_all_sql(sql, [self._id, self.TOP_XP_PAGE, offset])
+            left += await names.fetch(self._guild, [row['user'] for row in results])
+
+            for row in results:
+                user_id = int(row['user'])
+                name = names.resolve(self._id, user_id, self._guild)
+                if name is not None and len(users) < self.TOP_LIMIT:
+                    top.append((user_id, int(row['xp'])))
+                    users.append(User(user_id, self._id, None, name))
+
+            # If that was the last page, there is nobody else to check
+            if len(results) < self.TOP_XP_PAGE:
+                break
+
+            offset += self.TOP_XP_PAGE
+
+        # They are only removed now, as deleting rows while paging would move the later rows onto pages we have already read
+        for user_id in left:
+            await Guild.remove_member(self._id, user_id)
+
+        Guild._top_xp[self._id] = {'built': time.time(), 'users': top}
         return users
 
+    def get_top_xp_cache_time():
+        """
+        Get how long a top XP list can be kept for.
+        XP isn't per guild, so a user can earn it in a guild on another worker while they are on the list of one of ours,
+        and xp_changed() is only called in the process where it happened. So in cluster mode the lists are only kept briefly.
+        :return: int Seconds
+        """
+        if int(getattr(lib.get_config(), 'cluster_processes', 0) or 0) > 1:
+            return Guild.CLUSTER_TOP_XP_CACHE_TIME
+
+        return Guild.TOP_XP_CACHE_TIME
+
+    def xp_changed(user_id, xp):
+        """
+        Drop the cached top XP lists in this process which a user's new XP could change: the ones they are on, and the ones they could now get onto
+        :param user_id:
+        :param xp: The user's new XP
+        :return: void
+        """
+        user_id = int(user_id)
+        for guild_id, cached in list(Guild._top_xp.items()):
+
+            users = cached['users']
+            if any(user == user_id for user, amount in users):
+                Guild._top_xp.pop(guild_id, None)
+                continue
+
+            # If we know the guild's members and they aren't one of them, the list can't change
+            members = Guild._member_ids.get(guild_id)
+            if members is not None and user_id not in members['ids']:
+                continue
+
+            if len(users) < Guild.TOP_LIMIT or xp > users[-1][1]:
+                Guild._top_xp.pop(guild_id, None)
+
+    def forget_top_xp(guild_id):
+        """
+        Drop the cached top XP list of a guild
+        :param guild_id:
+        :return: void
+        """
+        Guild._top_xp.pop(int(guild_id), None)
+
+    def get_member_ids(guild):
+        """
+        Get the set of IDs of the members of a guild, building it from the member list if it isn't cached or is out of date.
+        If the bot isn't caching all the members of the guild, it is built from the membership table instead.
+        :param guild: discord.Guild
+        :return: set
+        """
+        cached = Guild._member_ids.get(guild.id)
+        if cached is None or time.time() - cached['built'] > Guild.MEMBER_CACHE_TIME:
+
+            if guild.chunked:
+                ids = set(member.id for member in guild.members)
+            else:
+                ids = set(int(row['user']) for row in Database.instance().get_all('guild_members', {'guild': guild.id}, ['user']))
+
+            cached = Guild._member_ids[guild.id] = {'built': time.time(), 'ids': ids}
+
+        return cached['ids']
+
+    async def add_member(guild_id, user_id):
+        """
+        Add a member who has joined a guild to its cached member set and the guild_members table
+        :param guild_id:
+        :param user_id:
+        :return: void
+        """
+        cached = Guild._member_ids.get(int(guild_id))
+        if cached is not None:
+            cached['ids'].add(int(user_id))
+
+        await AsyncDatabase.instance().upsert('guild_members', {'guild': int(guild_id), 'user': int(user_id)}, ['guild', 'user'])
+        Guild.forget_top_xp(guild_id)
+
+    async def remove_member(guild_id, user_id):
+        """
+        Remove a member who has left a guild from its cached member set and the guild_members table
+        :param guild_id:
+        :param user_id:
+        :return: void
+        """
+        cached = Guild._member_ids.get(int(guild_id))
+        if cached is not None:
+            cached['ids'].discard(int(user_id))
+
+        await AsyncDatabase.instance().delete('guild_members', {'guild': int(guild_id), 'user': int(user_id)})
+        Guild.forget_top_xp(guild_id)
+
+    async def forget_members(guild_id):
+        """
+        Throw away the cached member set and the guild_members rows for a guild, e.g. when the bot leaves it
+        :param guild_id:
+        :return: void
+        """
+        Guild._member_ids.pop(int(guild_id), None)
+        Guild.forget_top_xp(guild_id)
+        await AsyncDatabase.instance().delete('guild_members', {'guild': int(guild_id)})
+
+    def sync_members(guild_id, member_ids, complete=True):
+        """
+        Bring the guild_members table in line with a guild's member list, for any joins and leaves missed while the bot was offline.
+        This is blocking, so should be run on a database thread with AsyncDatabase.call(). The member IDs should be read
+        from the guild on the event loop, as the member list can change while this is running.
+        :param guild_id:
+        :param member_ids: set
+        :param complete: Whether the member list has every member in it. If not, nobody is removed from the table.
+        :return: void
+        """
+        db = Database.instance()
+        guild_id = int(guild_id)
+
+        stored = set(int(row['user']) for row in db.get_all('guild_members', {'guild': guild_id}, ['user']))
+        joined = [{'guild': guild_id, 'user': user_id} for user_id in member_ids - stored]
+        left = list(stored - member_ids) if complete else []
+
+        with db.transaction():
+
+            for i in range(0, len(joined), Guild.SYNC_BATCH_SIZE):
+                db.upsert_many('guild_members', joined[i:i + Guild.SYNC_BATCH_SIZE], ['guild', 'user'])
+
+            for i in range(0, len(left), Guild.SYNC_BATCH_SIZE):
+                batch = left[i:i + Guild.SYNC_BATCH_SIZE]
+                db.execute('DELETE FROM guild_members WHERE guild = %s AND user IN (' + ', '.join(['%s'] * len(batch)) + ')', [guild_id] + batch)
+
+        if joined or left:
+            Guild.forget_top_xp(guild_id)
+
     def get_from_bot(bot, guild_id):
         """
         Load the guild object from the bot.
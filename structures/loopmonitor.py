@@ -0,0 +1,117 @@
+import asyncio, lib, sys, threading, time, traceback
+from datetime import datetime
+from structures.singleton import Singleton
+
+@Singleton
+class LoopMonitor:
+    """
+    Measures how late the event loop is running, and catches whatever is blocking it.
+    A coroutine on the loop records a heartbeat every INTERVAL seconds and how late it woke up. A watchdog thread checks
+    the heartbeat, and if the loop has been stuck for longer than the `loop_block_ms` setting, it captures the stack of
+    the loop's thread (e.g. the cog, and the Database method it is waiting on) and the task running, into the blocking report.
+    """
+
+    INTERVAL = 0.25 # Seconds
+    THRESHOLD = 500 # Milliseconds
+    REPORT = 'logs/blocking.log'
+    STACK_LIMIT = 25 # Frames
+
+    def __init__(self):
+
+        self.threshold = float(getattr(lib.get_config(), 'loop_block_ms', self.THRESHOLD)) / 1000
+
+        self.loop = None
+        self._runner = None
+        self._watcher = None
+        self._stopping = threading.Event()
+        self._loop_thread = None
+        self._beat = time.monotonic()
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+
+    def start(self, loop):
+        """
+        Start measuring the lag on the loop. The watchdog thread is started once the loop is running.
+        :param loop:
+        :return: void
+        """
+        self.loop = loop
+        if self._runner is None or self._runner.done():
+            self._runner = loop.create_task(self.run())
+
+    def stop(self):
+        """
+        Stop the monitor and its watchdog thread
+        :return: void
+        """
+        self._stopping.set()
+        if self._runner is not None:
+            self._runner.cancel()
+            self._runner = None
+        self._watcher = None
+
+    async def run(self):
+        """
+        Record a heartbeat, sleep for INTERVAL, and see how much later than that we woke up
+        :return: void
+        """
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+
+        if self._watcher is None:
+            self._stopping.clear()
+            self._watcher = threading.Thread(target=self.watch, name='loop-monitor', daemon=True)
+            self._watcher.start()
+
+        while True:
+            start = time.monotonic()
+            self._beat = start
+            await asyncio.sleep(self.INTERVAL)
+            self.lag = max(0.0, time.monotonic() - start - self.INTERVAL)
+            self.max_lag = max(self.max_lag, self.lag)
+
+    def watch(self):
+        """
+        The watchdog thread. Reports the loop once for each heartbeat it gets stuck on.
+        :return: void
+        """
+        reported = None
+        while not self._stopping.wait(self.INTERVAL):
+
+            beat = self._beat
+            blocked = time.monotonic() - beat - self.INTERVAL
+            if blocked >= self.threshold and reported != beat:
+                reported = beat
+                self.stalls += 1
+                try:
+                    self.report(blocked)
+                except Exception as e:
+                    lib.error('Exception in loop monitor: ' + str(e))
+
+    def report(self, blocked):
+        """
+        Capture what the loop's thread is doing right now and write it to the blocking report
+        :param blocked: Seconds the loop has been blocked for so far
+        :return: void
+        """
+        frame = sys._current_frames().get(self._loop_thread)
+        stack = ''.join(traceback.format_stack(frame, limit=self.STACK_LIMIT)) if frame is not None else ''
+
+        # Work out which task is hogging the loop, if it's inside one
+        task = asyncio.current_task(self.loop)
+        coro = None
+        if task is not None:
+            coro = task.get_coro() if hasattr(task, 'get_coro') else getattr(task, '_coro', None)
+        name = getattr(coro, '__qualname__', None) or repr(coro)
+
+        now = datetime.now().strftime("%Y-%m-%d, %H:%M:%S")
+        with open(self.REPORT, 'a') as file:
+            file.write('[' + now + '][BLOCKED] Event loop blocked for ' + str(round(blocked * 1000)) + 'ms in task ' + str(name) + '\n' + stack + '\n')
+
+    def get_lag(self):
+        """
+        Get the loop lag measurements
+        :return: dict
+        """
+        return {'lag': self.lag, 'max': self.max_lag, 'stalls': self.stalls}
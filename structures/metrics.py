@@ -0,0 +1,220 @@
+import asyncio, bisect, lib, time
+from structures.db import AsyncDatabase, Database
+from structures.loopmonitor import LoopMonitor
+from structures.names import NameCache
+from structures.querylog import QueryLog
+from structures.scheduler import Scheduler
+from structures.singleton import Singleton
+
+@Singleton
+class Metrics:
+    """
+    Collects metrics about the bot process and serves them over HTTP in the Prometheus text format.
+    The server is only started if the `metrics_port` setting is set, and only listens on `metrics_host` (localhost by default).
+    Counters and histograms are updated as commands run. Gauges are worked out when the metrics are requested.
+    """
+
+    PREFIX = 'writerbot_'
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30) # Upper bounds of the command latency buckets, in seconds
+    GAUGE_CACHE = 15 # Seconds to keep the gauges which need database queries, so frequent scrapes don't add load
+    REQUEST_TIMEOUT = 5 # Seconds
+
+    def __init__(self):
+
+        # The exporter is off unless a port is set
+        config = lib.get_config()
+        self.host = getattr(config, 'metrics_host', '127.0.0.1')
+        self.port = int(getattr(config, 'metrics_port', 0) or 0)
+
+        self.bot = None
+        self._server = None
+        self._commands = {}
+        self._errors = {}
+        self._latency = {}
+        self._gauges = {}
+        self._gauges_time = 0
+
+    def is_enabled(self):
+        return self.port > 0
+
+    async def start(self, bot):
+        """
+        Start the HTTP server, if it is enabled
+        :param bot:
+        :return: void
+        """
+        self.bot = bot
+        if not self.is_enabled() or self._server is not None:
+            return
+
+        # Each worker in a cluster listens on the next port along
+        port = self.port + (bot.cluster.id if bot.cluster is not None else 0)
+        self._server = await asyncio.start_server(self.handle, self.host, port)
+        lib.debug('[METRICS] Serving metrics on http://' + self.host + ':' + str(port) + '/metrics')
+
+    def stop(self):
+        """
+        Stop the HTTP server
+        :return: void
+        """
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    def command_finished(self, cog, command, seconds, failed):
+        """
+        Record a command which has been run
+        :param cog:
+        :param command:
+        :param seconds: How long it took
+        :param failed: Whether it raised an error
+        :return: void
+        """
+        key = (str(cog), command)
+        self._commands[key] = self._commands.get(key, 0) + 1
+
+        if failed:
+            self._errors[key] = self._errors.get(key, 0) + 1
+
+        histogram = self._latency.get(key)
+        if histogram is None:
+            histogram = self._latency[key] = {'buckets': [0] * (len(self.BUCKETS) + 1), 'sum': 0.0, 'count': 0}
+
+        histogram['buckets'][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+    def get_gauges(self):
+        """
+        Get the gauges which need the database, from memory if they were worked out in the last GAUGE_CACHE seconds
+        :return: dict
+        """
+        if time.time() - self._gauges_time > self.GAUGE_CACHE:
+
+            db = Database.instance()
+            self._gauges = {
+                'active_sprints': db.get('sprints', {'completed': 0}, ['COUNT(id) as cnt'])['cnt'],
+                'active_events': db.get('events', {'started': 1, 'ended': 0}, ['COUNT(id) as cnt'])['cnt'],
+                'pending_tasks': db.get('tasks', None, ['COUNT(id) as cnt'])['cnt'],
+            }
+            self._gauges_time = time.time()
+
+        return self._gauges
+
+    def render(self):
+        """
+        Build the metrics page
+        :return: str
+        """
+        from structures.task import Task
+
+        lines = []
+
+        def metric(name, type, help, samples):
+            lines.append('# HELP ' + self.PREFIX + name + ' ' + help)
+            lines.append('# TYPE ' + self.PREFIX + name + ' ' + type)
+            for labels, value in samples:
+                label = '{' + ','.join(key + '="' + self.escape(val) + '"' for key, val in labels.items()) + '}' if labels else ''
+                lines.append(self.PREFIX + name + label + ' ' + str(value))
+
+        metric('commands_total', 'counter', 'Commands run, by cog and command',
+               [({'cog': cog, 'command': command}, count) for (cog, command), count in self._commands.items()])
+        metric('command_errors_total', 'counter', 'Commands which raised an error, by cog and command',
+               [({'cog': cog, 'command': command}, count) for (cog, command), count in self._errors.items()])
+
+        # The histogram buckets are cumulative, and it has its sum and count alongside them
+        lines.append('# HELP ' + self.PREFIX + 'command_seconds Time taken to run commands, in seconds')
+        lines.append('# TYPE ' + self.PREFIX + 'command_seconds histogram')
+        for (cog, command), histogram in self._latency.items():
+            labels = 'cog="' + self.escape(cog) + '",command="' + self.escape(command) + '"'
+            total = 0
+            for bound, count in zip(self.BUCKETS + ('+Inf',), histogram['buckets']):
+                total += count
+                lines.append(self.PREFIX + 'command_seconds_bucket{' + labels + ',le="' + str(bound) + '"} ' + str(total))
+            lines.append(self.PREFIX + 'command_seconds_sum{' + labels + '} ' + str(histogram['sum']))
+            lines.append(self.PREFIX + 'command_seconds_count{' + labels + '} ' + str(histogram['count']))
+
+        gauges = self.get_gauges()
+        metric('active_sprints', 'gauge', 'Sprints which have not been completed', [({}, gauges['active_sprints'])])
+        metric('active_events', 'gauge', 'Events which have started and not ended', [({}, gauges['active_events'])])
+        metric('pending_tasks', 'gauge', 'Rows in the tasks table', [({}, gauges['pending_tasks'])])
+
+        scheduler = Scheduler.instance().get_backlog(time.time())
+        depth = Task.get_queue_depth()
+        metric('scheduler_tasks', 'gauge', 'Tasks held by the scheduler', [({}, scheduler['pending'])])
+        metric('scheduler_due_tasks', 'gauge', 'Tasks held by the scheduler which are due to run', [({}, scheduler['due'])])
+        metric('task_queue', 'gauge', 'Tasks waiting for a free slot or running', [({'state': state}, count) for state, count in depth.items()])
+
+        pool = AsyncDatabase.instance().get_pool_stats()
+        if pool is not None:
+            metric('db_pool_connections', 'gauge', 'Connections in the database pool',
+                   [({'state': 'used'}, pool['size'] - pool['free']), ({'state': 'free'}, pool['free'])])
+            metric('db_pool_max', 'gauge', 'Maximum connections in the database pool', [({}, pool['max'])])
+
+        metric('db_queries_total', 'counter', 'Database queries run', [({}, QueryLog.instance().get_query_count())])
+        metric('db_slow_queries_total', 'counter', 'Database queries slower than the slow query threshold', [({}, QueryLog.instance().get_slow_count())])
+
+        strings = lib.get_string_stats()
+        metric('string_lookups_total', 'counter', 'Language strings looked up, by whether the string was found',
+               [({'result': 'hit'}, strings['hits']), ({'result': 'miss'}, strings['misses'])])
+        metric('guild_language_lookups_total', 'counter', 'Guild language lookups, by whether it was already in memory',
+               [({'result': 'hit'}, strings['lang_hits']), ({'result': 'miss'}, strings['lang_misses'])])
+        metric('language_reloads_total', 'counter', 'Times a language file was loaded from disk', [({}, strings['reloads'])])
+        metric('languages_loaded', 'gauge', 'Language files held in memory', [({}, strings['languages'])])
+
+        names = NameCache.instance()
+        metric('name_cache_lookups_total', 'counter', 'Member names looked up, by whether they were in the name cache',
+               [({'result': 'hit'}, names.hits), ({'result': 'miss'}, names.misses)])
+        metric('name_cache_size', 'gauge', 'Member names held in the name cache', [({}, names.get_size())])
+
+        loop = LoopMonitor.instance().get_lag()
+        metric('event_loop_lag_seconds', 'gauge', 'How late the event loop last woke up from a sleep', [({}, loop['lag'])])
+        metric('event_loop_max_lag_seconds', 'gauge', 'The highest event loop lag seen', [({}, loop['max'])])
+        metric('event_loop_blocked_total', 'counter', 'Times the event loop was blocked for longer than the threshold', [({}, loop['stalls'])])
+
+        if self.bot is not None:
+            metric('guilds', 'gauge', 'Guilds the bot is in', [({}, len(self.bot.guilds))])
+            metric('gateway_latency_seconds', 'gauge', 'Latency of the gateway heartbeat, by shard',
+                   [({'shard': str(shard)}, latency) for shard, latency in self.bot.latencies])
+
+        return '\n'.join(lines) + '\n'
+
+    def escape(self, value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    async def handle(self, reader, writer):
+        """
+        Handle an HTTP request to the metrics server. Only `GET /metrics` is supported.
+        :param reader:
+        :param writer:
+        :return: void
+        """
+        try:
+
+            request = await asyncio.wait_for(reader.readline(), self.REQUEST_TIMEOUT)
+
+            # Read the headers up to the blank line, we don't need any of them.
+            while True:
+                line = await asyncio.wait_for(reader.readline(), self.REQUEST_TIMEOUT)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.render()
+            else:
+                status, body = '404 Not Found', 'Not found\n'
+
+            body = body.encode('utf-8')
+            writer.write(('HTTP/1.1 ' + status + '\r\n'
+                          'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                          'Content-Length: ' + str(len(body)) + '\r\n'
+                          'Connection: close\r\n\r\n').encode('latin-1') + body)
+            await writer.drain()
+
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            lib.error('Exception serving metrics: ' + str(e))
+        finally:
+            writer.close()
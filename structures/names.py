@@ -0,0 +1,140 @@
+import asyncio, discord, lib, time
+from collections import OrderedDict
+from structures.singleton import Singleton
+
+@Singleton
+class NameCache:
+    """
+    Keeps the display names of guild members in memory, by (guild, user), so lists of users can be rendered without
+    looking up every member. The least recently used names are dropped once there are more than the `name_cache_size`
+    setting. The cache is kept up to date by the member join, update and leave events, and anyone not found in it or
+    in the bot's member cache can be fetched from Discord in a batch with fetch().
+    A user can be cached with a name of None when they leave the guild, or when Discord says they aren't a member.
+    That only lasts for LEFT_CACHE_TIME, and is overridden if they turn up in the bot's member cache, in case they have
+    rejoined since.
+    """
+
+    MAX_SIZE = 50000 # Names
+    LEFT_CACHE_TIME = 300 # Seconds to remember that a user is not a member of a guild
+    FETCH_CONCURRENCY = 5 # Member requests to make to Discord at the same time
+    MISSING = object()
+
+    def __init__(self):
+
+        self.max_size = int(getattr(lib.get_config(), 'name_cache_size', self.MAX_SIZE))
+        self._names = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, guild_id, user_id):
+        """
+        Get a member's display name from the cache
+        :param guild_id:
+        :param user_id:
+        :return: The name, None if they are known not to be a member, or NameCache.MISSING if they aren't cached
+        """
+        key = (int(guild_id), int(user_id))
+        entry = self._names.get(key)
+        if entry is None:
+            return self.MISSING
+
+        name, cached = entry
+        if name is None and time.time() - cached > self.LEFT_CACHE_TIME:
+            del self._names[key]
+            return self.MISSING
+
+        self._names.move_to_end(key)
+        return name
+
+    def set(self, guild_id, user_id, name):
+        """
+        Cache a member's display name, dropping the least recently used name if the cache is full
+        :param guild_id:
+        :param user_id:
+        :param name: The display name, or None if they are not a member of the guild
+        :return: void
+        """
+        key = (int(guild_id), int(user_id))
+        self._names[key] = (name, time.time())
+        self._names.move_to_end(key)
+
+        while len(self._names) > self.max_size:
+            self._names.popitem(last=False)
+
+    def forget_guild(self, guild_id):
+        """
+        Drop all the cached names of a guild, e.g. when the bot leaves it
+        :param guild_id:
+        :return: void
+        """
+        guild_id = int(guild_id)
+        for key in [key for key in self._names.keys() if key[0] == guild_id]:
+            del self._names[key]
+
+    def forget_user(self, user_id):
+        """
+        Drop all the cached names of a user, e.g. when they change their username, so any name without a nickname is loaded again
+        :param user_id:
+        :return: void
+        """
+        user_id = int(user_id)
+        for key in [key for key in self._names.keys() if key[1] == user_id]:
+            del self._names[key]
+
+    def resolve(self, guild_id, user_id, guild=None):
+        """
+        Get a member's display name from the cache, or from the bot's member cache if we have the guild object
+        :param guild_id:
+        :param user_id:
+        :param guild: discord.Guild or None
+        :return: The name, or None if they couldn't be found
+        """
+        name = self.get(guild_id, user_id)
+        if name is not self.MISSING and name is not None:
+            self.hits += 1
+            return name
+
+        # If they are cached as having left, they may have rejoined while the bot was offline, so check the member cache anyway
+        self.misses += 1
+        member = guild.get_member(int(user_id)) if guild is not None else None
+        if member is None:
+            return None
+
+        self.set(guild_id, user_id, member.display_name)
+        return member.display_name
+
+    async def fetch(self, guild, user_ids):
+        """
+        Make sure the names of a list of users are cached, e.g. before rendering a leaderboard.
+        Anyone not in the cache or the bot's member cache is requested from Discord, a few at a time.
+        :param guild: discord.Guild
+        :param user_ids:
+        :return: list of the user IDs which Discord says are not members of the guild
+        """
+        left = []
+        if guild is None:
+            return left
+
+        # Anyone the leave event told us about in the last LEFT_CACHE_TIME isn't requested
+        missing = []
+        for user_id in user_ids:
+            if self.resolve(guild.id, user_id, guild) is None and self.get(guild.id, user_id) is self.MISSING:
+                missing.append(int(user_id))
+
+        for i in range(0, len(missing), self.FETCH_CONCURRENCY):
+            batch = missing[i:i + self.FETCH_CONCURRENCY]
+            members = await asyncio.gather(*[guild.fetch_member(user_id) for user_id in batch], return_exceptions=True)
+
+            # Anyone who isn't a member is cached as having left, so they aren't requested again for LEFT_CACHE_TIME.
+            # Anything else which went wrong is left out of the cache, so they are tried again next time.
+            for user_id, member in zip(batch, members):
+                if isinstance(member, discord.Member):
+                    self.set(guild.id, user_id, member.display_name)
+                elif isinstance(member, discord.NotFound):
+                    self.set(guild.id, user_id, None)
+                    left.append(user_id)
+
+        return left
+
+    def get_size(self):
+        return len(self._names)
@@ -1,10 +1,26 @@
 import lib
 from structures.db import Database
+from structures.unitofwork import UnitOfWork
 
 class Project:
 
+    def __new__(cls, id):
+
+        # If this project has already been loaded in the current command or task, use the same object
+        unit = UnitOfWork.current()
+        if unit is not None:
+            project = unit.get(('project', int(id)))
+            if project is not None:
+                return project
+
+        return super().__new__(cls)
+
     def __init__(self, id):
 
+        # If this is an object from the unit of work, it is already loaded
+        if hasattr(self, '_id'):
+            return
+
         self.__db = Database.instance()
 
         record = self.__db.get('projects', {'id': id})
@@ -16,6 +32,10 @@ class Project:
             self._words = record['words']
             self._completed = record['completed']
 
+            unit = UnitOfWork.current()
+            if unit is not None:
+                unit.add(('project', int(self._id)), self)
+
     def get_id(self):
         return self._id
 
@@ -0,0 +1,199 @@
+import bisect, contextvars, json, lib, os, queue, re, sys, threading
+from datetime import datetime
+from structures.singleton import Singleton
+
+# The command or task running the current queries. Each asyncio task has its own copy of this.
+_caller = contextvars.ContextVar('query_caller', default=None)
+
+# Groups of placeholders, e.g. IN lists and the rows of a multi-row insert, and the WHENs of a multi-row update
+_placeholders = re.compile(r'\(\s*%s(?:\s*,\s*%s)*\s*\)')
+_rows = re.compile(r'\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+')
+_cases = re.compile(r'(?:WHEN %s THEN %s\s*)+')
+
+@Singleton
+class QueryLog:
+    """
+    Records how long every database query takes, grouped by the shape of the query (its SQL, without the parameters).
+    Each shape gets a latency histogram, row counts and the commands or tasks which ran it. Any query slower than the
+    `slow_query_ms` setting is also written to the slow query log, as a line of JSON. The log is written by a background
+    thread, so a slow query doesn't also mean a blocking file write on the event loop.
+    """
+
+    BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000) # Upper bounds of the histogram buckets, in ms
+    MAX_SHAPES = 1000 # Any shapes after this many are all counted together as OTHER
+    OTHER = '(other queries)'
+    SLOW_THRESHOLD = 250 # Milliseconds
+    SLOW_LOG = 'logs/slow.log'
+
+    def __init__(self):
+
+        self.threshold = float(getattr(lib.get_config(), 'slow_query_ms', self.SLOW_THRESHOLD))
+        self._shapes = {}
+        self._queries = 0
+        self._slow = 0
+        self._slow_queue = queue.Queue()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+    def set_caller(self, name):
+        """
+        Set the name of the command or task running queries in the current asyncio task
+        :param name:
+        :return: void
+        """
+        _caller.set(name)
+
+    def get_caller(self):
+        """
+        Get the name of the command or task running queries in the current asyncio task
+        :return: str or None
+        """
+        return _caller.get()
+
+    def record(self, sql, seconds, rows):
+        """
+        Record a query which has been run
+        :param sql:
+        :param seconds: How long it took
+        :param rows: Number of rows returned or affected
+        :return: void
+        """
+        ms = seconds * 1000
+        caller = _caller.get()
+        self._queries += 1
+        sql = self.get_shape(sql)
+
+        # Once there are MAX_SHAPES, any new shapes are counted together
+        key = sql if sql in self._shapes or len(self._shapes) < self.MAX_SHAPES else self.OTHER
+
+        shape = self._shapes.get(key)
+        if shape is None:
+            shape = self._shapes[key] = {'count': 0, 'total': 0.0, 'max': 0.0, 'rows': 0, 'slow': 0,
+                                         'buckets': [0] * (len(self.BUCKETS) + 1), 'callers': {}}
+
+        shape['count'] += 1
+        shape['total'] += ms
+        shape['max'] = max(shape['max'], ms)
+        shape['rows'] += max(rows or 0, 0)
+        shape['buckets'][bisect.bisect_left(self.BUCKETS, ms)] += 1
+        shape['callers'][caller] = shape['callers'].get(caller, 0) + 1
+
+        if ms >= self.threshold:
+            shape['slow'] += 1
+            self._slow += 1
+            self.log_slow(sql, ms, rows, caller)
+
+    def get_shape(self, sql):
+        """
+        Get the shape of a query, with any group of placeholders collapsed into one, so the same statement run with a
+        different number of rows or IN values is counted together
+        :param sql:
+        :return: str
+        """
+        sql = _placeholders.sub('(...)', sql)
+        sql = _rows.sub('(...)', sql)
+        return _cases.sub('WHEN %s THEN %s ... ', sql)
+
+    def log_slow(self, sql, ms, rows, caller):
+        """
+        Queue a slow query to be written to the slow query log
+        :param sql:
+        :param ms:
+        :param rows:
+        :param caller:
+        :return: void
+        """
+        entry = {
+            'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'ms': round(ms, 2),
+            'rows': rows,
+            'caller': caller,
+            'source': self.find_source(),
+            'sql': sql
+        }
+
+        self._slow_queue.put(entry)
+
+        # Start the writer the first time there is something for it to write
+        if self._writer is None:
+            with self._writer_lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self.write_slow, name='slow-query-log', daemon=True)
+                    self._writer.start()
+
+    def write_slow(self):
+        """
+        Write the queued slow queries to the slow query log, for as long as the process runs.
+        Any which have built up while the last ones were being written go in together.
+        :return: void
+        """
+        while True:
+
+            entries = [self._slow_queue.get()]
+            while not self._slow_queue.empty():
+                entries.append(self._slow_queue.get_nowait())
+
+            try:
+                with open(self.SLOW_LOG, 'a') as file:
+                    file.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+            except OSError as e:
+                lib.error('Could not write to the slow query log: ' + str(e))
+
+    def find_source(self):
+        """
+        Find the line of code outside of the database classes which ran the query.
+        This walks the frames directly rather than using traceback, which would read the source of every line in the stack.
+        :return: str
+        """
+        frame = sys._getframe(1)
+        while frame is not None:
+            file = os.path.basename(frame.f_code.co_filename)
+            if file not in ('db.py', 'querylog.py', 'contextlib.py'):
+                return file + ':' + str(frame.f_lineno) + ' ' + frame.f_code.co_name
+            frame = frame.f_back
+        return None
+
+    def percentile(self, shape, percent):
+        """
+        Estimate a percentile of a shape's latency from its histogram
+        :param shape:
+        :param percent:
+        :return: float The upper bound of the bucket the percentile falls in, or the max for the last bucket
+        """
+        target = shape['count'] * percent / 100
+        seen = 0
+        for i, count in enumerate(shape['buckets']):
+            seen += count
+            if seen >= target:
+                return self.BUCKETS[i] if i < len(self.BUCKETS) else shape['max']
+        return shape['max']
+
+    def get_stats(self, limit=10):
+        """
+        Get the aggregates of the query shapes which have taken the most time in total
+        :param limit:
+        :return: list of dicts
+        """
+        stats = []
+        for sql, shape in self._shapes.items():
+            stats.append({
+                'sql': sql,
+                'count': shape['count'],
+                'total': shape['total'],
+                'avg': shape['total'] / shape['count'],
+                'p50': self.percentile(shape, 50),
+                'p99': self.percentile(shape, 99),
+                'max': shape['max'],
+                'rows': shape['rows'] / shape['count'],
+                'slow': shape['slow'],
+                'caller': max(shape['callers'].items(), key=lambda item: item[1])[0]
+            })
+
+        stats.sort(key=lambda item: item['total'], reverse=True)
+        return stats[:limit]
+
+    def get_query_count(self):
+        return self._queries
+
+    def get_slow_count(self):
+        return self._slow
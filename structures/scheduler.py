@@ -0,0 +1,227 @@
+import asyncio, heapq, lib, time
+from structures.db import Database
+from structures.singleton import Singleton
+
+@Singleton
+class Scheduler:
+    """
+    Keeps the pending tasks in memory, in a heap ordered by their due time, and sleeps until the next one is due.
+    The tasks table is still written to for every change, so that nothing is lost if the bot restarts, but it is only
+    read when the scheduler starts and every SYNC_INTERVAL seconds after that, to pick up anything changed outside of this process.
+    Only the tasks for guilds on this process's shards are held, so each process only runs its own guilds' tasks.
+    """
+
+    SYNC_INTERVAL = 600 # Seconds
+    RETRY_DELAY = 30 # Seconds
+
+    def __init__(self):
+        self.__db = Database.instance()
+        self.bot = None
+        self._tasks = {}
+        self._heap = []
+        self._wake = asyncio.Event()
+        self._runner = None
+        self._next_sync = 0
+
+    def start(self, bot):
+        """
+        Start the scheduler loop, if it is not already running
+        :param bot:
+        :return:
+        """
+        self.bot = bot
+        if self._runner is None or self._runner.done():
+            self._runner = bot.loop.create_task(self.run())
+
+    def stop(self):
+        """
+        Stop the scheduler loop
+        :return:
+        """
+        if self._runner is not None:
+            self._runner.cancel()
+            self._runner = None
+
+    def sync(self):
+        """
+        Reload all of the tasks for this process's shards from the database
+        :return:
+        """
+        shard_ids = self.bot.shard_ids if self.bot is not None else None
+        shard_count = self.bot.shard_count if self.bot is not None else None
+
+        if shard_ids is None or not shard_count:
+            records = self.__db.get_all('tasks')
+        else:
+
+            # Tasks which aren't for a guild are run by the process with shard 0.
+            # The shard is worked out from the guild ID, so this reads the whole table, but it's only pending tasks and only every SYNC_INTERVAL.
+            sql = 'SELECT * FROM tasks WHERE MOD(guild >> 22, %s) IN (' + ', '.join(['%s'] * len(shard_ids)) + ')'
+            if 0 in shard_ids:
+                sql += ' OR guild IS NULL'
+            records = self.__db.get_all_sql(sql, [shard_count] + list(shard_ids))
+
+        self._tasks = {}
+        self._heap = []
+        for record in records:
+            self._tasks[record['id']] = record
+            self._heap.append((int(record['time']), record['id']))
+
+        heapq.heapify(self._heap)
+        self._next_sync = time.time() + self.SYNC_INTERVAL
+        lib.debug('[SCHEDULER] Loaded ' + str(len(self._tasks)) + ' tasks')
+
+    def push(self, record):
+        """
+        Add a task to the scheduler, or move it to a new time if it is already there.
+        If it is now the next task due, wake the loop up so it doesn't oversleep.
+        :param record: The tasks row
+        :return:
+        """
+        if self.bot is not None and not self.bot.owns_guild(record['guild']):
+            return
+
+        due = int(record['time'])
+        earliest = self._heap[0][0] if self._heap else None
+
+        # If we already have it queued for that time, there's no need for another entry in the heap
+        existing = self._tasks.get(record['id'])
+        if existing is not None and int(existing['time']) == due:
+            self._tasks[record['id']] = record
+            return
+
+        self._tasks[record['id']] = record
+        heapq.heappush(self._heap, (due, record['id']))
+
+        if earliest is None or due < earliest:
+            self._wake.set()
+
+    def discard(self, id):
+        """
+        Remove a task from the scheduler. Its entry in the heap is skipped when it comes up.
+        :param id:
+        :return:
+        """
+        self._tasks.pop(id, None)
+
+    def refresh(self, id):
+        """
+        Reload a single task from the database, after finding it has been changed by another process
+        :param id:
+        :return:
+        """
+        record = self.__db.get('tasks', {'id': id})
+
+        # If it has gone, forget about it. If it has been moved later, queue it up for its new time.
+        # Otherwise another process is still running it, so leave it to be retried.
+        if record is None:
+            self.discard(id)
+        elif int(record['time']) > time.time():
+            self.push(record)
+
+    def cancel(self, object, object_id, type=None):
+        """
+        Remove all the tasks for a specific object
+        :param object:
+        :param object_id:
+        :param type:
+        :return:
+        """
+        for id, record in list(self._tasks.items()):
+            if record['object'] == object and record['objectid'] == object_id and (type is None or record['type'] == type):
+                self.discard(id)
+
+    def get_backlog(self, now):
+        """
+        Count the tasks held by the scheduler, and how many of them are due
+        :param now:
+        :return: dict
+        """
+        due = sum(1 for record in self._tasks.values() if int(record['time']) <= now)
+        return {'pending': len(self._tasks), 'due': due}
+
+    def pop_due(self, now):
+        """
+        Take all of the tasks which are due off the heap
+        :param now:
+        :return: list of Task objects
+        """
+        from structures.task import Task
+
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+
+            when, id = heapq.heappop(self._heap)
+            record = self._tasks.get(id)
+
+            # Skip anything which has been removed or rescheduled since this entry was pushed.
+            if record is None or int(record['time']) != when:
+                continue
+
+            due.append(Task(id, record))
+
+        return due
+
+    def retry_later(self, tasks, now):
+        """
+        Any task which didn't finish and wasn't rescheduled by its run, is tried again after RETRY_DELAY seconds.
+        The retry time is only kept in memory, the database row still has the time it was originally due.
+        :param tasks:
+        :param now:
+        :return:
+        """
+        for task in tasks:
+            record = self._tasks.get(task.id)
+            if record is not None and int(record['time']) == task.time:
+                self.push(dict(record, time=int(now) + self.RETRY_DELAY))
+
+    async def dispatch(self, tasks, now):
+        """
+        Execute a batch of due tasks, then queue up a retry for any which didn't finish
+        :param tasks:
+        :param now:
+        :return:
+        """
+        from structures.task import Task
+
+        try:
+            await Task.execute_all(self.bot, tasks)
+        except Exception as e:
+            lib.error('Exception running scheduled tasks: ' + str(e))
+        finally:
+            self.retry_later(tasks, now)
+
+    async def run(self):
+        """
+        The scheduler loop. Run any due tasks, then sleep until the next one is due, a new earlier one is pushed,
+        or it is time to sync with the database again.
+        :return:
+        """
+        while True:
+
+            now = time.time()
+
+            try:
+
+                if now >= self._next_sync:
+                    self.sync()
+
+                # Hand the due tasks off to run in the background, so a slow one doesn't hold up the next.
+                due = self.pop_due(now)
+                if due:
+                    self.bot.loop.create_task(self.dispatch(due, now))
+                    continue
+
+            except Exception as e:
+                lib.error('Exception in scheduler: ' + str(e))
+                await asyncio.sleep(self.RETRY_DELAY)
+                continue
+
+            next_due = self._heap[0][0] if self._heap else self._next_sync
+            delay = max(0, min(next_due, self._next_sync) - time.time())
+
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
@@ -3,7 +3,6 @@ from operator import itemgetter
 from structures.db import Database
 from structures.event import Event
 from structures.guild import Guild
-from structures.project import Project
 from structures.task import Task
 from structures.xp import Experience
 from structures.user import User
@@ -16,6 +15,11 @@ class Sprint:
         'end': 'end', # This is the task for ending the writing phase of the sprint and asking for final word counts
         'complete': 'complete' # This is the task for actually completing the sprint, calculating xp, posting final results, etc...
     }
+    ACTIVE_CACHE_TIME = 300 # Seconds before a guild's active sprint is loaded from the database again
+
+    # The active sprint of each guild, by guild ID, with its sprints row (or None if there isn't one) and its sprint_users
+    # rows by user ID. Every write to the sprint goes through this class, which keeps these up to date as well.
+    _active = {}
 
     def __init__(self, guild_id, bot=None):
 
@@ -67,11 +71,10 @@ class Sprint:
         :return: bool
         """
         if by == 'id':
-            params = {'id': self._id, 'completed': 0}
+            result = self.__db.get('sprints', {'id': self._id, 'completed': 0})
         else:
-            params = {'guild': self._guild, 'completed': 0}
+            result = Sprint.get_active(self._guild)['record']
 
-        result = self.__db.get('sprints', params)
         if result:
             self._id = result['id']
             self._guild = result['guild']
@@ -164,8 +167,7 @@ class Sprint:
         Check if everyone sprinting has declared their final word counts
         :return: bool
         """
-        results = self.__db.get_all_sql('SELECT * FROM sprint_users WHERE sprint = %s AND ending_wc = 0', [self._id])
-        return len(results) == 0
+        return all(int(row['ending_wc']) != 0 for row in self.get_user_sprints().values())
 
     def get_user_sprint(self, user_id):
         """
@@ -173,15 +175,63 @@ class Sprint:
         :param user_id:
         :return:
         """
-        return self.__db.get('sprint_users', {'sprint': self._id, 'user': user_id})
+        record = self.get_user_sprints().get(int(user_id))
+        return dict(record) if record is not None else None
 
     def get_users(self):
         """
-        Get an array of all the sprint_users records for users taking part in this sprint
+        Get an array of the IDs of all the users taking part in this sprint
         :return:
         """
-        users = self.__db.get_all('sprint_users', {'sprint': self._id})
-        return [int(row['user']) for row in users]
+        return list(self.get_user_sprints().keys())
+
+    def get_user_sprints(self):
+        """
+        Get the sprint_users records for this sprint by user ID, from the guild's active sprint if this is it
+        :return: dict
+        """
+        if self._guild is not None:
+            active = Sprint.get_active(self._guild)
+            if active['record'] is not None and active['record']['id'] == self._id:
+                return active['users']
+
+        return {int(row['user']): row for row in self.__db.get_all('sprint_users', {'sprint': self._id})}
+
+    def get_active(guild_id):
+        """
+        Get the active sprint of a guild from memory, loading it and its users from the database if it isn't there or is out of date
+        :param guild_id:
+        :return: dict
+        """
+        guild_id = int(guild_id)
+        active = Sprint._active.get(guild_id)
+        if active is None or time.time() - active['loaded'] > Sprint.ACTIVE_CACHE_TIME:
+
+            db = Database.instance()
+            record = db.get('sprints', {'guild': guild_id, 'completed': 0})
+            users = {int(row['user']): row for row in db.get_all('sprint_users', {'sprint': record['id']})} if record else {}
+            active = Sprint._active[guild_id] = {'loaded': time.time(), 'record': record, 'users': users}
+
+        return active
+
+    def forget_active(guild_id):
+        """
+        Drop the active sprint of a guild from memory, so it is loaded again next time
+        :param guild_id:
+        :return: void
+        """
+        Sprint._active.pop(int(guild_id), None)
+
+    def get_active_users(self):
+        """
+        Get the sprint_users records held in memory for this sprint, if it is the guild's active sprint and has been loaded
+        :return: dict or None
+        """
+        active = Sprint._active.get(int(self._guild)) if self._guild is not None else None
+        if active is not None and active['record'] is not None and active['record']['id'] == self._id:
+            return active['users']
+
+        return None
 
     def get_notify_users(self):
         """
@@ -214,6 +264,12 @@ class Sprint:
         now = int(time.time())
         self.__db.update('sprints', {'completed': now}, {'id': self._id})
 
+        # It is no longer the active sprint
+        active = Sprint._active.get(int(self._guild))
+        if active is not None and active['record'] is not None and active['record']['id'] == self._id:
+            active['record'] = None
+            active['users'] = {}
+
     def set_ended(self):
         """
         Mark the 'end' column as 0 in the database, to force the sprint to end
@@ -221,6 +277,10 @@ class Sprint:
         """
         self.__db.update('sprints', {'end': 0}, {'id': self._id})
 
+        active = Sprint._active.get(int(self._guild))
+        if active is not None and active['record'] is not None and active['record']['id'] == self._id:
+            active['record']['end'] = 0
+
     def join(self, user_id, starting_wc=0):
         """
         Add a user to a sprint with an optional starting word count number
@@ -237,7 +297,12 @@ class Sprint:
            now = self._start
 
         # Insert the sprint_users record
-        self.__db.insert('sprint_users', {'sprint': self._id, 'user': user_id, 'starting_wc': starting_wc, 'current_wc': starting_wc, 'ending_wc': 0, 'timejoined': now})
+        record = {'sprint': self._id, 'user': int(user_id), 'starting_wc': starting_wc, 'current_wc': starting_wc, 'ending_wc': 0, 'timejoined': now}
+        self.__db.insert('sprint_users', record)
+
+        users = self.get_active_users()
+        if users is not None:
+            users[int(user_id)] = dict(record, id=self.__db.last_insert_id(), project=None, event=None)
 
     def set_project(self, project_id, user_id):
         """
@@ -246,6 +311,10 @@ class Sprint:
         :param user_id:
         :return:
         """
+        users = self.get_active_users()
+        if users is not None and int(user_id) in users:
+            users[int(user_id)]['project'] = project_id
+
         return self.__db.update('sprint_users', {'project': project_id}, {'sprint': self._id, 'user': user_id})
 
     def leave(self, user_id):
@@ -256,6 +325,10 @@ class Sprint:
         """
         self.__db.delete('sprint_users', {'sprint': self._id, 'user': user_id})
 
+        users = self.get_active_users()
+        if users is not None:
+            users.pop(int(user_id), None)
+
     def cancel(self, context):
         """
         Cancel the sprint and notify the users who were taking part
@@ -268,6 +341,7 @@ class Sprint:
         # Delete sprints and sprint_users records
         self.__db.delete('sprint_users', {'sprint': self._id})
         self.__db.delete('sprints', {'id': self._id})
+        Sprint.forget_active(self._guild)
 
         # Delete pending scheduled tasks
         Task.cancel('sprint', self._id)
@@ -332,6 +406,10 @@ class Sprint:
 
         self.__db.update('sprint_users', update, {'sprint': self._id, 'user': user_id})
 
+        users = self.get_active_users()
+        if users is not None and int(user_id) in users:
+            users[int(user_id)].update(update)
+
     async def complete(self, context=None, bot=None):
         """
         Finish the sprint, calculate all the WPM and XP and display results
@@ -351,14 +429,11 @@ class Sprint:
         # Mark this sprint as complete so the cron doesn't pick it up and start processing it again
         self.set_complete()
 
-        # Get all the users taking part
-        users = self.get_users()
-
-        # Loop through them and get their full sprint info
-        for user_id in users:
+        # Get all the users taking part, with their full sprint info
+        user_sprints = self.__db.get_all('sprint_users', {'sprint': self._id})
 
-            user = User(user_id, self._guild, context=context, bot=bot, channel=self.get_channel())
-            user_sprint = self.get_user_sprint(user_id)
+        # Loop through them and work out their results
+        for user_sprint in user_sprints:
 
             # If they didn't submit an ending word count, use their current one
             if user_sprint['ending_wc'] == 0:
@@ -379,45 +454,15 @@ class Sprint:
                 if user_sprint['timejoined'] <= 0 or self._end_reference == 0:
                     time_sprinted = self._length
 
-                # Calculate the WPM from their time sprinted
-                wpm = Sprint.calculate_wpm(wordcount, time_sprinted)
-
-                # See if it's a new record for the user
-                user_record = user.get_record('wpm')
-                wpm_record = True if user_record is None or wpm > int(user_record) else False
-
-                # If it is a record, update their record in the database
-                if wpm_record:
-                    user.update_record('wpm', wpm)
-
-                # Give them XP for finishing the sprint
-                await user.add_xp(Experience.XP_COMPLETE_SPRINT)
-
-                # Increment their stats
-                user.add_stat('sprints_completed', 1)
-                user.add_stat('sprints_words_written', wordcount)
-                user.add_stat('total_words_written', wordcount)
-
-                # Increment their words towards their goal
-                await user.add_to_goals(wordcount)
-
-                # If they were writing in a Project, update its word count.
-                if user_sprint['project'] is not None:
-                    project = Project(user_sprint['project'])
-                    project.add_words(wordcount)
-
-                # is there an event running on this server?
-                event = Event.get_by_guild(self._guild)
-                if event and event.is_running():
-                    event.add_words(user.get_id(), wordcount)
-
                 # Push user to results
                 results.append({
-                    'user': user,
+                    'user': User(user_sprint['user'], self._guild, context=context, bot=bot, channel=self.get_channel()),
                     'wordcount': wordcount,
-                    'wpm': wpm,
-                    'wpm_record': wpm_record,
-                    'xp': Experience.XP_COMPLETE_SPRINT
+                    'wpm': Sprint.calculate_wpm(wordcount, time_sprinted),
+                    'wpm_record': False,
+                    'xp': Experience.XP_COMPLETE_SPRINT,
+                    'project': user_sprint['project'],
+                    'won': False
                 })
 
         # Sort the results
@@ -430,17 +475,19 @@ class Sprint:
 
             # If the user finished in the top 5 and they weren't the only one sprinting, earn extra XP
             if position <= 5 and len(results) > 1:
-
-                extra_xp = math.ceil(Experience.XP_WIN_SPRINT / position)
-                result['xp'] += extra_xp
-                await result['user'].add_xp(extra_xp)
+                result['xp'] += math.ceil(Experience.XP_WIN_SPRINT / position)
 
             # If they actually won the sprint, increase their stat by 1
             if position == 1:
-                result['user'].add_stat('sprints_won', 1)
+                result['won'] = True
 
             position += 1
 
+        # Save everyone's records, stats, xp, goals, etc... in one go, and then post any level up or goal messages.
+        if len(results) > 0:
+            for user, message in self.save_results(results):
+                await user.say(message)
+
         # Post the final message with the results
         if len(results) > 0:
 
@@ -464,6 +511,110 @@ class Sprint:
         # Send the message, either via the context or directly to the channel
         await self.say(message, context, bot)
 
+    def save_results(self, results):
+        """
+        Write the results of the sprint to the database.
+        Everything the users need is loaded in a few queries, worked out in memory, and then written back in a single transaction.
+        This also adds any XP for completing a daily goal onto the result.
+        :param results:
+        :return: Array of (User, message) tuples for the level up and goal messages to post
+        """
+        messages = []
+        users = {result['user'].get_id(): result for result in results}
+        ids = list(users.keys())
+        in_users = ', '.join(['%s'] * len(ids))
+
+        # Load the current records, xp and goals of everyone in the results
+        records = self.__db.get_all_sql('SELECT * FROM user_records WHERE record = %s AND user IN (' + in_users + ')', ['wpm'] + ids)
+        xp = self.__db.get_all_sql('SELECT * FROM user_xp WHERE user IN (' + in_users + ')', ids)
+        goals = self.__db.get_all_sql('SELECT * FROM user_goals WHERE type = %s AND user IN (' + in_users + ')', ['daily'] + ids)
+
+        # Index them by user, so we can look them up
+        records = {int(row['user']): row for row in reversed(records)}
+        xp = {int(row['user']): row for row in reversed(xp)}
+        goals = {int(row['user']): row for row in reversed(goals)}
+
+        updates = {'user_goals': {}}
+        increments = {'projects': {}}
+        upserts = {'user_records': [], 'user_stats': [], 'user_xp': []}
+        new_xp = {}
+
+        for user_id, result in users.items():
+
+            user = result['user']
+            wordcount = result['wordcount']
+            user_stats = {'sprints_completed': 1, 'sprints_words_written': wordcount, 'total_words_written': wordcount}
+
+            # The goal XP is announced in its own message, so it is kept out of the sprint XP shown in the results
+            earned = result['xp']
+
+            if result['won']:
+                user_stats['sprints_won'] = 1
+
+            # See if it's a new record for the user
+            record = records.get(user_id)
+            if record is None or result['wpm'] > int(record['value']):
+                result['wpm_record'] = True
+                upserts['user_records'].append({'user': user_id, 'record': 'wpm', 'value': result['wpm']})
+
+            # Increment their words towards their goal, and see if they have just met it
+            goal = goals.get(user_id)
+            if goal is not None:
+
+                current = max(0, int(goal['current']) + wordcount)
+                if current >= goal['goal'] and not goal['completed']:
+                    user_stats['daily_goals_completed'] = 1
+                    earned += Experience.XP_COMPLETE_GOAL['daily']
+                    messages.append((user, lib.get_string('goal:met', self._guild).format(user.get_mention(), 'daily', str(goal['goal']), str(Experience.XP_COMPLETE_GOAL['daily']))))
+                    updates['user_goals'][goal['id']] = {'current': current, 'completed': 1}
+                else:
+                    updates['user_goals'][goal['id']] = {'current': current}
+
+            # Increment their stats
+            for name, amount in user_stats.items():
+                upserts['user_stats'].append({'user': user_id, 'name': name, 'value': amount})
+
+            # Give them their XP, and check if that takes them up a level
+            user_xp = xp.get(user_id)
+            current_xp = int(user_xp['xp']) if user_xp is not None else 0
+            upserts['user_xp'].append({'user': user_id, 'xp': earned})
+            new_xp[user_id] = current_xp + earned
+
+            level = Experience(current_xp + earned).get_level()
+            if level > Experience(current_xp).get_level():
+                messages.append((user, lib.get_string('levelup', self._guild).format(user.get_mention(), level)))
+
+            # If they were writing in a Project, update its word count.
+            if result['project'] is not None:
+                project = increments['projects'].setdefault(result['project'], {'words': 0})
+                project['words'] += wordcount
+
+        # Is there an event running on this server?
+        event = Event.get_by_guild(self._guild)
+        event_words = {}
+        if event and event.is_running():
+            event_words = {user_id: result['wordcount'] for user_id, result in users.items()}
+
+        with self.__db.transaction() as db:
+
+            for table, values in updates.items():
+                db.update_many(table, values)
+
+            for table, values in increments.items():
+                db.update_many(table, values, increment=True)
+
+            db.upsert_many('user_records', upserts['user_records'], ['user', 'record'])
+            db.upsert_many('user_stats', upserts['user_stats'], ['user', 'name'], increment=True)
+            db.upsert_many('user_xp', upserts['user_xp'], ['user'], increment=True)
+
+            for user_id, total in new_xp.items():
+                Guild.xp_changed(user_id, total)
+
+            if event_words:
+                event.add_words_many(event_words)
+
+        return messages
+
     async def end(self, context=None, bot=None):
         """
         Mark the 'end' time of the sprint as 0 in the database and ask for final word counts
@@ -495,7 +646,7 @@ class Sprint:
         task_time = int(time.time()) + delay
 
         # Schedule the cron task
-        Task.schedule(self.TASKS['complete'], task_time, 'sprint', self._id)
+        Task.schedule(self.TASKS['complete'], task_time, 'sprint', self._id, self._guild)
 
     async def say(self, message, context=None, bot=None):
         """
@@ -539,7 +690,7 @@ class Sprint:
         await self.post_start(bot=bot)
 
         # Schedule the end task.
-        Task.schedule(self.TASKS['end'], self._end, 'sprint', self._id)
+        Task.schedule(self.TASKS['end'], self._end, 'sprint', self._id, self._guild)
         return True
 
     async def task_end(self, bot) -> bool:
@@ -595,6 +746,7 @@ class Sprint:
         # Insert the record into the database
         db = Database.instance()
         db.insert('sprints', {'guild': guild, 'channel': channel, 'start': start, 'end': end, 'end_reference': end_reference, 'length': length, 'createdby': createdby, 'created': created})
+        Sprint.forget_active(guild)
 
         # Return the new object using this guild id
         return Sprint(guild)
@@ -0,0 +1,74 @@
+import lib
+from structures.db import Database
+from structures.singleton import Singleton
+
+@Singleton
+class StatBuffer:
+    """
+    Holds increments to the user_stats table in memory, so they can be written in bulk instead of one query each time.
+    Anything reading a user's stats should add on the pending amounts from here, as they may not be in the database yet.
+    """
+
+    def __init__(self):
+        self.__db = Database.instance()
+        self._pending = {}
+
+    def add(self, user_id, name, amount):
+        """
+        Add an increment to a user's stat
+        :param user_id:
+        :param name:
+        :param amount:
+        :return: void
+        """
+        key = (int(user_id), name)
+        self._pending[key] = self._pending.get(key, 0) + int(amount)
+
+    def get_pending(self, user_id):
+        """
+        Get the increments which haven't been written yet for a user
+        :param user_id:
+        :return: dict of stat name => amount
+        """
+        user_id = int(user_id)
+        return {name: amount for (user, name), amount in self._pending.items() if user == user_id}
+
+    def discard(self, user_id, name=None):
+        """
+        Throw away the pending increments for a user's stat, or all of their stats.
+        This should be done before the stat is set to a new value or deleted.
+        :param user_id:
+        :param name:
+        :return: void
+        """
+        user_id = int(user_id)
+        for key in list(self._pending.keys()):
+            if key[0] == user_id and (name is None or key[1] == name):
+                del self._pending[key]
+
+    def flush(self):
+        """
+        Write all the pending increments to the database, in one statement.
+        Stats which already have a row are incremented with `value = value + amount`, and the rest are inserted.
+        :return: int Number of stats written
+        """
+        pending = {key: amount for key, amount in self._pending.items() if amount != 0}
+        self._pending = {}
+
+        if not pending:
+            return 0
+
+        try:
+            rows = [{'user': user, 'name': name, 'value': amount} for (user, name), amount in pending.items()]
+            self.__db.upsert_many('user_stats', rows, ['user', 'name'], increment=True)
+
+        except Exception as e:
+
+            # Put the increments back, so they are written next time.
+            for key, amount in pending.items():
+                self._pending[key] = self._pending.get(key, 0) + amount
+
+            lib.error('Exception flushing user stats: ' + str(e))
+            raise
+
+        return len(pending)
@@ -1,25 +1,45 @@
-import lib, time
+import asyncio, lib, os, socket, time
 from structures.db import Database
+from structures.querylog import QueryLog
+from structures.scheduler import Scheduler
+from structures.unitofwork import UnitOfWork
 
 from pprint import pprint
 
 class Task:
 
-    def __init__(self, id):
+    MAX_CONCURRENT = 5 # Tasks running at the same time
+    TIMEOUT = 300 # Seconds
+    LEASE_TIME = 120 # Seconds a claim on a task lasts, unless it is renewed
+    LEASE_RENEW = 30 # Seconds between renewing the claim on a running task
+
+    # Identifies this process as the owner of the tasks it claims
+    OWNER = socket.gethostname() + ':' + str(os.getpid())
+
+    # Shared state for running the tasks concurrently, created the first time tasks are executed
+    _semaphore = None
+    _locks = {}
+    _depth = {'queued': 0, 'running': 0}
+
+    def __init__(self, id, record=None):
         """
-        Load a Task object by its ID
+        Load a Task object by its ID, or from its tasks row if we already have it
         :param id:
+        :param record:
         """
         self.__db = Database.instance()
         self.id = None
 
-        record = self.__db.get('tasks', {'id': id})
+        if record is None:
+            record = self.__db.get('tasks', {'id': id})
+
         if record:
             self.id = record['id']
             self.type = record['type']
             self.time = record['time']
             self.object = record['object']
             self.object_id = record['objectid']
+            self.guild = record['guild']
             self.processing = record['processing']
             self.recurring = record['recurring']
             self.run_every_seconds = record['runeveryseconds']
@@ -45,27 +65,72 @@ class Task:
         """
         return self.processing == 1
 
-    def start_processing(self, value):
+    def claim(self):
+        """
+        Try to claim the task for this process, with a lease which expires after LEASE_TIME seconds.
+        This is done in one conditional UPDATE, so if several processes try at once, only one of them can get it.
+        A task which is already claimed can be taken over if its lease has expired.
+        :return: bool
+        """
+        now = int(time.time())
+        claimed = self.__db.execute('UPDATE tasks SET processing = 1, owner = %s, lease = %s WHERE id = %s AND time <= %s AND (processing = 0 OR lease < %s)',
+                                    [self.OWNER, now + self.LEASE_TIME, self.id, now, now])
+        return claimed == 1
+
+    def renew(self):
+        """
+        Extend the lease on a task we have claimed
+        :return: bool
+        """
+        now = int(time.time())
+        return self.__db.update('tasks', {'lease': now + self.LEASE_TIME}, {'id': self.id, 'owner': self.OWNER}) == 1
+
+    def release(self):
         """
-        Mark the task as processing or not
-        :param value: 0 or 1
+        Give up our claim on the task, so it can be picked up again
         :return:
         """
-        return self.__db.update('tasks', {'processing': value}, {'id': self.id})
+        return self.__db.update('tasks', {'processing': 0, 'owner': None, 'lease': 0}, {'id': self.id, 'owner': self.OWNER})
+
+    async def heartbeat(self):
+        """
+        Keep renewing the lease for as long as the task is running
+        :return:
+        """
+        while True:
+            await asyncio.sleep(self.LEASE_RENEW)
+            self.renew()
 
     async def run(self, bot):
         """
         Run this task
-        TODO: In the future, make this better. For now it will do.
         :return: bool
         """
 
-        # If the task is already processing, don't go any further.
-        if self.is_processing():
-            return True
-
-        # Mark the task as processing so other shards don't pick it up.
-        self.start_processing(1)
+        # Only the process with the shard for the task's guild runs it. Any other which picked it up forgets about it.
+        if not bot.owns_guild(self.guild):
+            Scheduler.instance().discard(self.id)
+            return False
+
+        # If another process has the task claimed, or it has been moved or deleted since we loaded it, don't go any further.
+        if not self.claim():
+            Scheduler.instance().refresh(self.id)
+            return False
+
+        heartbeat = asyncio.ensure_future(self.heartbeat())
+        QueryLog.instance().set_caller('task:' + str(self.object) + ':' + str(self.type))
+        UnitOfWork.begin()
+        try:
+            return await self.__run(bot)
+        finally:
+            heartbeat.cancel()
+            UnitOfWork.end()
+
+    async def __run(self, bot):
+        """
+        Run the method for this task on its object, once we have claimed it
+        :return: bool
+        """
 
         # Build a variable to store the method name to run
         method = 'task_' + str(self.type)
@@ -79,7 +144,7 @@ class Task:
             from structures.sprint import Sprint
 
             sprint = Sprint.get(self.object_id)
-            if sprint.is_valid():
+            if sprint is not None and sprint.is_valid():
                 result = await getattr(sprint, method)(bot)
             else:
                 # If the sprint doesn't exist, then we can just delete this task.
@@ -96,27 +161,31 @@ class Task:
 
             from structures.event import Event
 
-            event = Event(self.object_id)
-            if event.is_valid():
-                result = await getattr(event, method)(bot)
+            # Tasks without an object ID are for all the events, rather than a specific one
+            if self.object_id is None:
+                result = await getattr(Event, method)(bot)
             else:
-                # If the event doesn't exist, then we can just delete this task.
-                return True
+                event = Event(self.object_id)
+                if event.is_valid():
+                    result = await getattr(event, method)(bot)
+                else:
+                    # If the event doesn't exist, then we can just delete this task.
+                    result = True
 
         else:
             # Invalid task object. May as well just delete this task.
             print('Invalid task object: ' + self.object)
             result = True
 
+        # If it's a recurring task, set its next run time. Do this before releasing it, so nothing else can claim it in between.
+        if self.is_recurring():
+            self.set_recur()
+
         # If we finished the task, and it's not a recurring one, delete it.
         if result is True and not self.is_recurring():
             self.delete()
         else:
-            self.start_processing(0)
-
-        # If it's a recurring task, set its next run time.
-        if self.is_recurring():
-            self.set_recur()
+            self.release()
 
         return result
 
@@ -128,28 +197,90 @@ class Task:
         now = int(time.time())
         next = now + int(self.run_every_seconds)
         lib.debug('setting next run time for ' + str(self.id) + ' to: ' + str(next))
-        return self.__db.update('tasks', {'time': next}, {'id': self.id})
+        result = self.__db.update('tasks', {'time': next}, {'id': self.id})
+
+        Scheduler.instance().push(self.get_record(time=next, processing=0, owner=None, lease=0))
+        return result
+
+    def get_record(self, **changes):
+        """
+        Get the tasks row for this task, with any changed values
+        :return: dict
+        """
+        record = {'id': self.id, 'type': self.type, 'time': self.time, 'object': self.object, 'objectid': self.object_id,
+                  'guild': self.guild, 'processing': self.processing, 'recurring': self.recurring, 'runeveryseconds': self.run_every_seconds}
+        record.update(changes)
+        return record
 
     def delete(self):
         """
         Delete the task
         :return:
         """
+        Scheduler.instance().discard(self.id)
         return self.__db.delete('tasks', {'id': self.id})
 
-    async def execute_all(bot):
+    async def execute_all(bot, tasks):
         """
-        Execute a pass of the scheduled tasks that are currently pending
+        Execute the scheduled tasks which are now due.
+        They run concurrently, up to the `task_concurrency` setting at a time, but tasks for the same object
+        (e.g. the same sprint) are always run one after the other.
+        :param bot:
+        :param tasks: Array of Task objects
         :return:
         """
-        now = int(time.time())
-        db = Database.instance()
+        if Task._semaphore is None:
+            Task._semaphore = asyncio.Semaphore(int(getattr(lib.get_config(), 'task_concurrency', Task.MAX_CONCURRENT)))
+
+        await asyncio.gather(*[Task.execute(bot, task) for task in tasks if task.is_valid()])
+
+    async def execute(bot, task):
+        """
+        Execute a single task, waiting for its turn on its object and for a free slot
+        :param bot:
+        :param task:
+        :return: bool
+        """
+        # Get the lock for this object, keeping count of how many tasks are using it so we know when to throw it away.
+        key = (task.object, task.object_id)
+        lock = Task._locks.setdefault(key, {'lock': asyncio.Lock(), 'users': 0})
+        lock['users'] += 1
 
-        pending = db.get_all_sql('SELECT id FROM tasks WHERE time <= %s ORDER BY id ASC', [now])
-        for row in pending:
-            task = Task(row['id'])
-            if task.is_valid():
-                result = await task.run(bot)
+        Task._depth['queued'] += 1
+        waiting = True
+
+        try:
+            async with lock['lock']:
+                async with Task._semaphore:
+
+                    Task._depth['queued'] -= 1
+                    Task._depth['running'] += 1
+                    waiting = False
+
+                    try:
+                        return await asyncio.wait_for(task.run(bot), Task.TIMEOUT)
+                    except asyncio.TimeoutError:
+                        lib.error('Task ' + str(task.id) + ' (' + str(task.object) + ' ' + str(task.type) + ') timed out after ' + str(Task.TIMEOUT) + ' seconds')
+                    except Exception as e:
+                        lib.error('Exception in task ' + str(task.id) + ' (' + str(task.object) + ' ' + str(task.type) + '): ' + str(e))
+
+                    # It didn't finish, so let it be picked up again.
+                    task.release()
+                    return False
+
+        finally:
+            Task._depth['queued' if waiting else 'running'] -= 1
+
+            lock['users'] -= 1
+            if lock['users'] == 0:
+                del Task._locks[key]
+
+    def get_queue_depth():
+        """
+        Get how many tasks are currently waiting to run and running
+        :return: dict
+        """
+        return dict(Task._depth)
 
     def cancel(object, object_id, type=None):
         """
@@ -165,6 +296,7 @@ class Task:
         if type is not None:
             params['type'] = type
 
+        Scheduler.instance().cancel(object, object_id, type)
         return db.delete('tasks', params)
 
     def get(type, object, object_id):
@@ -175,17 +307,30 @@ class Task:
         db = Database.instance()
         return db.get('tasks', {'type' : type, 'object': object, 'objectid': object_id})
 
-    def schedule(type, time, object, object_id):
+    def schedule(type, time, object, object_id, guild=None):
         """
         Schedule the task in the database
+        :param type:
+        :param time:
+        :param object:
+        :param object_id:
+        :param guild: ID of the guild the object belongs to, so the task is run by the process with that guild's shard
         :return:
         """
         db = Database.instance()
+        scheduler = Scheduler.instance()
 
         # If this task already exists, just update its time.
         record = Task.get(type, object, object_id)
         if record:
-            return db.update('tasks', {'time': time}, {'id': record['id']})
+            result = db.update('tasks', {'time': time}, {'id': record['id']})
+            record['time'] = time
         else:
             # Otherwise, create one.
-            return db.insert('tasks', {'type': type, 'time': time, 'object': object, 'objectid': object_id})
\ No newline at end of file
+            record = {'type': type, 'time': time, 'object': object, 'objectid': object_id, 'guild': guild}
+            result = db.insert('tasks', record)
+            record = dict(record, id=db.last_insert_id(), processing=0, recurring=0, runeveryseconds=None, owner=None, lease=0)
+
+        # Let the scheduler know, so it can wake up in time to run it.
+        scheduler.push(record)
+        return result
\ No newline at end of file
@@ -0,0 +1,67 @@
+import contextvars
+
+# The unit of work for the command or task currently running. Each asyncio task has its own copy of this.
+_current = contextvars.ContextVar('unit_of_work', default=None)
+
+class UnitOfWork:
+    """
+    Request-scoped identity map. While a unit of work is running, loading the same User, Project or Event twice gives
+    back the same object, so its data is only queried once. Objects can also leave their changes to be written when
+    the unit of work ends, instead of one query per change.
+    """
+
+    def __init__(self):
+        self._objects = {}
+
+    def get(self, key):
+        """
+        Get an object which has already been loaded in this unit of work
+        :param key: Tuple of the object type and its identifying values, e.g. ('user', id, guild)
+        :return: The object or None
+        """
+        return self._objects.get(key)
+
+    def add(self, key, object):
+        """
+        Add a loaded object to the identity map
+        :param key:
+        :param object:
+        :return: void
+        """
+        self._objects[key] = object
+
+    def flush(self):
+        """
+        Write the changes of every object which has any waiting
+        :return: void
+        """
+        for object in self._objects.values():
+            if hasattr(object, 'flush'):
+                object.flush()
+
+    def current():
+        """
+        Get the unit of work for the current command or task
+        :return: UnitOfWork or None
+        """
+        return _current.get()
+
+    def begin():
+        """
+        Start a new unit of work for the current command or task
+        :return: UnitOfWork
+        """
+        unit = UnitOfWork()
+        _current.set(unit)
+        return unit
+
+    def end():
+        """
+        Write any waiting changes and finish the current unit of work
+        :return: void
+        """
+        unit = _current.get()
+        _current.set(None)
+
+        if unit is not None:
+            unit.flush()
@@ -1,12 +1,34 @@
 import lib, math, time
 from structures.db import Database
+from structures.names import NameCache
 from structures.project import Project
+from structures.stats import StatBuffer
+from structures.unitofwork import UnitOfWork
 from structures.xp import Experience
 
 class User:
 
+    def __new__(cls, id, guild, *args, **kwargs):
+
+        # If this user has already been loaded in the current command or task, use the same object
+        unit = UnitOfWork.current()
+        if unit is not None:
+            user = unit.get(('user', int(id), int(guild)))
+            if user is not None:
+                return user
+
+        return super().__new__(cls)
+
     def __init__(self, id, guild, context=None, name=None, bot=None, channel=None):
 
+        # If this is an object from the unit of work, it is already set up, so just fill in anything we didn't have before
+        if hasattr(self, '_id'):
+            self.__context = context or self.__context
+            self.__bot = bot or self.__bot
+            self.__channel = channel or self.__channel
+            self._name = name or self._name
+            return
+
         # Initialise the database instance
         self.__db = Database.instance()
         self.__context = context
@@ -15,10 +37,16 @@ class User:
         self._id = int(id)
         self._guild = int(guild)
         self._name = name
+        self._loaded = False
         self._xp = None
         self._stats = None
         self._settings = None
         self._records = None
+        self._dirty = {}
+
+        unit = UnitOfWork.current()
+        if unit is not None:
+            unit.add(('user', self._id, self._guild), self)
 
     def get_id(self):
         return self._id
@@ -26,35 +54,33 @@ class User:
     def get_guild(self):
         return self._guild
 
+    def get_discord_guild(self):
+        """
+        Get the discord.Guild object for the user's guild, from the context or the bot if we have either
+        :return: discord.Guild or None
+        """
+        if self.__context is not None and self.__context.guild is not None:
+            return self.__context.guild
+        elif self.__bot is not None:
+            return self.__bot.get_guild(self._guild)
+        else:
+            return None
+
     def is_guild_member(self):
         """
         Try to work out if the user is still a member of the guild, otherwise they might have left
         :return bool:
         """
-        if self.__context is not None and self.__context.guild is not None and self.__context.guild.get_member(self._id) is not None:
-            return True
-        elif self.__bot is not None and self._guild is not None and self.__bot.get_guild(self._guild).get_member(self._id) is not None:
-            return True
-        else:
-            return False
+        return NameCache.instance().resolve(self._guild, self._id, self.get_discord_guild()) is not None
 
     def get_name(self):
         """
         Try and get the user's name on the guild, or just return it if it was passed through.
+        Names are looked up in the name cache, and then the guild member list if we have the context or bot.
         :return:
         """
-
-        # If the name is empty but we have the context, we can get it from the guild member list
-        if self._name is None and self.__context is not None and self.__context.guild is not None:
-            guild_member = self.__context.guild.get_member( self._id )
-            if guild_member is not None:
-                self._name = guild_member.display_name
-
-        # If the name is empty but we have the bot object, we can get it from the guilds and then the guild member list
-        elif self._name is None and self.__bot is not None and self._guild is not None:
-            guild_member = self.__bot.get_guild(self._guild).get_member(self._id)
-            if guild_member is not None:
-                self._name = guild_member.display_name
+        if self._name is None:
+            self._name = NameCache.instance().resolve(self._guild, self._id, self.get_discord_guild())
 
         return self._name
 
@@ -85,22 +111,121 @@ class User:
         self.__db.delete('user_records', {'user': self._id})
         self.__db.delete('user_stats', {'user': self._id})
         self.__db.delete('user_xp', {'user': self._id})
+        self.xp_changed(0)
+        StatBuffer.instance().discard(self._id)
         self.__db.delete('projects', {'user': self._id})
 
+        # Forget everything we had loaded or were waiting to write, so it gets loaded again fresh
+        self._loaded = False
+        self._xp = None
+        self._stats = None
+        self._records = None
+        self._settings = None
+        self._dirty = {}
+
+    def load(self):
+        """
+        Load the user's xp, stats, settings and records all at once, in a single query
+        :return: void
+        """
+        sql = "SELECT 'user_xp' AS source, id, NULL AS name, CAST(xp AS CHAR) AS value FROM user_xp WHERE user = %s " \
+              "UNION ALL SELECT 'user_stats', id, name, CAST(value AS CHAR) FROM user_stats WHERE user = %s " \
+              "UNION ALL SELECT 'user_settings', id, setting, value FROM user_settings WHERE user = %s AND guild = 0 " \
+              "UNION ALL SELECT 'user_records', id, record, CAST(value AS CHAR) FROM user_records WHERE user = %s"
+        records = self.__db.get_all_sql(sql, [self._id] * 4)
+
+        self._xp = None
+        self._stats = {}
+        self._settings = {}
+        self._records = {}
+
+        # Everything comes back as a string, so convert the values back to the types of their columns
+        for row in records:
+            if row['source'] == 'user_xp':
+                self.set_xp(row['id'], int(row['value'] or 0))
+            elif row['source'] == 'user_stats':
+                self._stats[row['name']] = int(row['value']) if row['value'] is not None else None
+            elif row['source'] == 'user_settings':
+                self._settings[row['name']] = row['value']
+            elif row['source'] == 'user_records':
+                self._records[row['name']] = float(row['value']) if row['value'] is not None else None
+
+        # Add on any increments which haven't been written to the database yet
+        for name, amount in StatBuffer.instance().get_pending(self._id).items():
+            self._stats[name] = int(self._stats.get(name) or 0) + amount
+
+        # Anything still waiting to be written is newer than what we just loaded
+        for (table, name), value in self._dirty.items():
+            if table == 'user_settings':
+                self._settings[name] = value
+            elif table == 'user_records':
+                self._records[name] = value
+
+        self._loaded = True
+
+    def save(self, table, name, value):
+        """
+        Write a changed setting or record value. If there is a unit of work running, it is left to be written when
+        that finishes, along with anything else changed in the meantime.
+        :param table:
+        :param name:
+        :param value:
+        :return: Result of the query, or 1 if it has been left for the unit of work
+        """
+        if UnitOfWork.current() is not None:
+            self._dirty[(table, name)] = value
+            return 1
+
+        return self.write(table, name, value)
+
+    def write(self, table, name, value):
+        """
+        Write a changed setting or record value to the database now
+        :param table:
+        :param name:
+        :param value:
+        :return: Result of the upsert query
+        """
+        # The user's own settings are stored with a guild of 0, to keep them apart from their guild-specific ones
+        if table == 'user_settings':
+            return self.__db.upsert('user_settings', {'user': self._id, 'guild': 0, 'setting': name, 'value': value}, ['user', 'guild', 'setting'])
+
+        else:
+            return self.__db.upsert('user_records', {'user': self._id, 'record': name, 'value': value}, ['user', 'record'])
+
+    def flush(self):
+        """
+        Write all the changes which were left for the unit of work
+        :return: void
+        """
+        dirty = self._dirty
+        self._dirty = {}
+
+        for (table, name), value in dirty.items():
+            self.write(table, name, value)
+
 
     def get_xp(self):
 
-        # If xp is None then we have't got the record yet, so try and get it.
-        if self._xp is None:
-            self.load_xp()
+        # If we haven't loaded the user yet, load everything up first
+        if not self._loaded:
+            self.load()
 
         return self._xp
 
-    def load_xp(self):
-        xp = self.__db.get('user_xp', {'user': self._id})
-        if xp:
-            experience = Experience(xp['xp'])
-            self._xp = {'id': xp['id'], 'xp': xp['xp'], 'lvl': experience.get_level(), 'next': experience.get_next_level_xp()}
+    def set_xp(self, id, xp):
+        experience = Experience(xp)
+        self._xp = {'id': id, 'xp': xp, 'lvl': experience.get_level(), 'next': experience.get_next_level_xp()}
+
+    def xp_changed(self, xp):
+        """
+        Let the guilds know the user's XP has changed, so any top XP list it affects is loaded again
+        :param xp:
+        :return: void
+        """
+        # Guild imports User, so it can't be imported until it is needed.
+        from structures.guild import Guild
+        Guild.xp_changed(self._id, xp)
 
     def get_xp_bar(self):
 
@@ -114,26 +239,29 @@ class User:
     def add_xp(self, amount):
 
         user_xp = self.get_xp()
-        if user_xp:
-            amount += int(user_xp['xp'])
-
-        return self.update_xp(amount)
+        current = int(user_xp['xp']) if user_xp else 0
 
-    async def update_xp(self, amount):
+        return self.update_xp(current + amount, amount)
 
+    async def update_xp(self, amount, increment=None):
+        """
+        Set the user's XP, and post a message if they have gone up a level.
+        XP can be added by sprint results or another command at the same time, so it is written straight away rather than
+        left for the unit of work, and if we are adding XP it is added onto the value in the database.
+        :param amount: The new XP total
+        :param increment: The amount being added, if XP is being added rather than set
+        :return: Result of the upsert query
+        """
         user_xp = self.get_xp()
+        current_level = user_xp['lvl'] if user_xp else 1
 
-        # If they already have an XP record, update it
-        if user_xp:
-            current_level = user_xp['lvl']
-            result = self.__db.update('user_xp', {'xp': amount}, {'id': user_xp['id']})
+        # Work out the new level on the user object, then save the XP
+        self.set_xp(user_xp['id'] if user_xp else None, amount)
+        if increment is None:
+            result = self.__db.upsert('user_xp', {'user': self._id, 'xp': amount}, ['user'])
         else:
-            # Otherwise, insert a new one
-            current_level = 1
-            result = self.__db.insert('user_xp', {'user': self._id, 'xp': amount})
-
-        # Reload the XP onto the user object and into the user_xp variable
-        self.load_xp()
+            result = self.__db.upsert('user_xp', {'user': self._id, 'xp': increment}, ['user'], increment=['xp'])
+        self.xp_changed(amount)
         user_xp = self.get_xp()
 
         # If the level now is higher than it was, print the level up message
@@ -161,9 +289,9 @@ class User:
 
     def get_stat(self, name):
 
-        # If the stats property is None, then load it up first
+        # If the stats property is None, then load everything up first
         if self._stats is None:
-            self.load_stats()
+            self.load()
 
         # Now check if the key exists in the dictionary
         if name in self._stats:
@@ -171,57 +299,39 @@ class User:
         else:
             return None
 
-    def load_stats(self):
-
-        # Get the user_stats records
-        records = self.__db.get_all('user_stats', {'user': self._id})
-
-        # Reset the stats property
-        self._stats = {}
-
-        # Loop through the results and add to the stats property
-        for row in records:
-            self._stats[row['name']] = row['value']
-
     def update_stat(self, name, amount):
 
-        # If the user already has a value for this stat, we want to update
-        user_stat = self.get_stat(name)
-
-        # Update the value in the array
-        self._stats[name] = amount
+        # Any increments still waiting to be written would be overwritten, so throw them away.
+        StatBuffer.instance().discard(self._id, name)
 
-        if user_stat:
-            return self.__db.update('user_stats', {'value': amount}, {'user': self._id, 'name': name})
+        # If we have already loaded the stats, update the value in the array
+        if self._stats is not None:
+            self._stats[name] = amount
 
-        # Otherwise, we want to insert a new one
-        else:
-            return self.__db.insert('user_stats', {'user': self._id, 'name': name, 'value': amount})
+        return self.__db.upsert('user_stats', {'user': self._id, 'name': name, 'value': amount}, ['user', 'name'])
 
     def add_stat(self, name, amount):
 
-        # If the user already has a value for this stat, we want to get their current amount so we can increment it
-        user_stat = self.get_stat(name)
-
-        if user_stat:
-            amount = int(amount) + int(user_stat)
+        # Buffer the increment, to be written to the database along with everyone else's
+        StatBuffer.instance().add(self._id, name, amount)
 
-        # Now return the update_stat with the new amount (if incremented)
-        return self.update_stat(name, amount)
+        # If we have already loaded the stats, keep them up to date
+        if self._stats is not None:
+            self._stats[name] = int(self._stats.get(name) or 0) + int(amount)
 
     def get_settings(self):
 
-        # If the settings property is None, then load it up first
+        # If the settings property is None, then load everything up first
         if self._settings is None:
-            self.load_settings()
+            self.load()
 
         return self._settings
 
     def get_setting(self, setting):
 
-        # If the settings property is None, then load it up first
+        # If the settings property is None, then load everything up first
         if self._settings is None:
-            self.load_settings()
+            self.load()
 
         # Now check if the key exists in the dictionary
         if setting in self._settings:
@@ -229,32 +339,15 @@ class User:
         else:
             return None
 
-    def load_settings(self):
-
-        # Get the user_settings records
-        records = self.__db.get_all('user_settings', {'user': self._id})
-
-        # Reset the stats property
-        self._settings = {}
-
-        # Loop through the results and add to the stats property
-        for row in records:
-            self._settings[row['setting']] = row['value']
-
     def update_setting(self, setting, value):
 
-        # If the user already has a value for this setting, we want to update
-        user_setting = self.get_setting(setting)
+        # Make sure the settings are loaded, so the array stays up to date
+        self.get_settings()
 
         # Update the value in the array
         self._settings[setting] = value
 
-        if user_setting:
-            return self.__db.update('user_settings', {'value': value}, {'user': self._id, 'setting': setting})
-
-        # Otherwise, we want to insert a new one
-        else:
-            return self.__db.insert('user_settings', {'user': self._id, 'setting': setting, 'value': value})
+        return self.save('user_settings', setting, value)
 
     def get_guild_setting(self, setting):
         """
@@ -271,19 +364,15 @@ class User:
         Set a user's setting for a specific guild
         :param str setting:
         :param str value:
-        :return: Result of update or insert query
+        :return: Result of the upsert query
         """
-        result = self.get_guild_setting(setting)
-        if result:
-            return self.__db.update('user_settings', {'value': value}, {'id': result['id']})
-        else:
-            return self.__db.insert('user_settings', {'user': self._id, 'guild': self._guild, 'setting': setting, 'value': value})
+        return self.__db.upsert('user_settings', {'user': self._id, 'guild': self._guild, 'setting': setting, 'value': value}, ['user', 'guild', 'setting'])
 
     def get_record(self, name):
 
-        # If the records property is None, then load it up first
+        # If the records property is None, then load everything up first
         if self._records is None:
-            self.load_records()
+            self.load()
 
         # Now check if the key exists in the dictionary
         if name in self._records:
@@ -291,32 +380,15 @@ class User:
         else:
             return None
 
-    def load_records(self):
-
-        # Get the user_settings records
-        records = self.__db.get_all('user_records', {'user': self._id})
-
-        # Reset the stats property
-        self._records = {}
-
-        # Loop through the results and add to the stats property
-        for row in records:
-            self._records[row['record']] = row['value']
-
     def update_record(self, name, value):
 
-        # If the user already has a value for this record, we want to update
-        user_record = self.get_record(name)
+        # Make sure the records are loaded, so the array stays up to date
+        self.get_record(name)
 
         # Update the value in the array
         self._records[name] = value
 
-        if user_record:
-            return self.__db.update('user_records', {'value': value}, {'user': self._id, 'record': name})
-
-        # Otherwise, we want to insert a new one
-        else:
-            return self.__db.insert('user_records', {'user': self._id, 'record': name, 'value': value})
+        return self.save('user_records', name, value)
 
     def calculate_user_reset_time(self):
         timezone = self.get_setting('timezone') or 'UTC'